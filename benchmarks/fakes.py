@@ -0,0 +1,73 @@
+# coding=utf-8
+"""In-memory stand-ins for Mongo, Redis and the broker.
+
+The services create their clients at import time and the other modules
+import them by name, so `install` swaps every module global (and attribute
+of a module global object) referring to a real client with its fake. Import
+the modules to benchmark first, then call `install`.
+"""
+import sys
+from typing import Dict, Iterable, Tuple
+
+import pymongo.collection
+import pymongo.database
+import redis
+
+__all__ = ['install', 'eager']
+
+
+def _fake_for(value, mongo_client, redis_server, fake_redis: Dict):
+    import fakeredis
+
+    if isinstance(value, pymongo.collection.Collection):
+        return mongo_client[value.database.name][value.name]
+    if isinstance(value, pymongo.database.Database):
+        return mongo_client[value.name]
+    if isinstance(value, pymongo.MongoClient):
+        return mongo_client
+    if isinstance(value, redis.Redis):
+        db = int(value.connection_pool.connection_kwargs.get('db', 0))
+        if db not in fake_redis:
+            fake_redis[db] = fakeredis.FakeRedis(server=redis_server, db=db)
+        return fake_redis[db]
+    return None
+
+
+def install(prefixes: Tuple[str, ...] = ('celery_workers', 'gateways'),
+            objects: Iterable = ()):
+    # returns (mongo client, {redis db: client}) of the fakes
+    import fakeredis
+    import mongomock
+
+    mongo_client = mongomock.MongoClient()
+    redis_server = fakeredis.FakeServer()
+    fake_redis = {}
+
+    def patch(namespace, setter):
+        for name, value in list(namespace.items()):
+            fake = _fake_for(value, mongo_client, redis_server, fake_redis)
+            if fake is not None:
+                setter(name, fake)
+
+    holders = list(objects)
+    for module_name, module in list(sys.modules.items()):
+        if module is None or not module_name.startswith(prefixes):
+            continue
+        patch(vars(module), lambda name, fake: setattr(module, name, fake))
+        # e.g. session_manager.r, result_waiter.r
+        holders.extend(value for value in vars(module).values()
+                       if hasattr(value, '__dict__')
+                       and not isinstance(value, type)
+                       and type(value).__module__.startswith(prefixes))
+    for holder in holders:
+        patch(vars(holder), lambda name, fake: setattr(holder, name, fake))
+    return mongo_client, fake_redis
+
+
+def eager(*apps):
+    # tasks called through apply_async/delay run in place; send_task still
+    # goes to the broker, an in-memory one here
+    for app in apps:
+        app.conf.task_always_eager = True
+        app.conf.task_eager_propagates = True
+        app.conf.broker_url = 'memory://'
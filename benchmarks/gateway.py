@@ -0,0 +1,115 @@
+# coding=utf-8
+"""Serves the gateway in-process and drives it with benchmarks/http_load.py.
+
+    python -m benchmarks.gateway --fakes --records 10000 --concurrency 100
+
+With --fakes, the gateway runs on in-memory Mongo/Redis seeded with a
+synthetic corpus, an in-memory broker, and precomputed neighbors for the
+anonymous recommendations; without it, it uses gateways/config.ini and the
+data already there (pass the paths to load). Text search needs a real
+Mongo, mongomock has no $text.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+
+# the gateway reads config.ini from its working directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(os.path.join(ROOT, 'gateways'))
+sys.path.insert(0, ROOT)
+
+import uvicorn  # noqa: E402
+
+from gateways import main as gateway  # noqa: E402
+from benchmarks import fakes, history, http_load, s2corpus  # noqa: E402
+
+
+def seed(n_records: int, top_k: int = 50) -> dict:
+    # returns the paths to load, per endpoint
+    rng = random.Random(0)
+    records = []
+    for n in range(n_records):
+        record = s2corpus.make_record(n, n_records, n_records // 5, rng)
+        record['_id'] = record.pop('id')
+        records.append(record)
+    gateway.t_records.insert_many(records)
+
+    version = 'benchmark'
+    gateway.r.set(gateway.MODEL_VERSION_KEY, version)
+    gateway.t_neighbors.insert_many([{
+        '_id': record['_id'],
+        'model_version': version,
+        'paper_ids': [s2corpus.paper_id(rng.randrange(n_records))
+                      for _ in range(top_k)],
+    } for record in records])
+    gateway.r.zadd(gateway.TITLE_AUTOCOMPLETE_KEY, {
+        '\0'.join([gateway.normalize_title(record['title']),
+                   record['_id'], record['title']]): 0
+        for record in records})
+
+    sample = rng.sample(records, min(1000, n_records))
+    return {
+        'record': ['/record/%s' % record['_id'] for record in sample],
+        'record_doi': ['/record/doi:%s' % record['doi']
+                       for record in sample if record['doi']],
+        'autocomplete': ['/search/autocomplete?prefix=%s'
+                         % record['title'][:4].replace(' ', '+')
+                         for record in sample],
+        'recommend': ['/recommend/record/%s' % record['_id']
+                      for record in sample],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fakes', action='store_true')
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--endpoints', default=None,
+                        help="comma separated, all of them by default")
+    parser.add_argument('--path', action='append', default=[],
+                        help="GET paths to load without --fakes")
+    args = parser.parse_args()
+
+    if args.fakes:
+        fakes.install(('gateways',))
+        fakes.eager(gateway.celery_app)
+        endpoints = seed(args.records)
+    else:
+        endpoints = {'custom': args.path}
+    if args.endpoints:
+        endpoints = {name: endpoints[name]
+                     for name in args.endpoints.split(',')}
+
+    server = uvicorn.Server(uvicorn.Config(
+        gateway.app, host='127.0.0.1', port=args.port, log_level='warning'))
+    url = 'http://127.0.0.1:%d' % args.port
+
+    def load():
+        while not server.started:
+            threading.Event().wait(0.1)
+        try:
+            for name, paths in endpoints.items():
+                method = 'PUT' if name == 'recommend' else 'GET'
+                result = http_load.run_load(url, paths, args.concurrency,
+                                            args.duration, method)
+                history.record('gateway.' + name, {
+                    'concurrency': args.concurrency,
+                    'records': args.records if args.fakes else None,
+                    'fakes': args.fakes,
+                }, {key: result[key] for key in (
+                    'requests', 'errors', 'throughput', 'p50_ms', 'p99_ms')})
+        finally:
+            server.should_exit = True
+
+    # uvicorn installs its signal handlers, so it keeps the main thread
+    threading.Thread(target=load, daemon=True).start()
+    server.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Benchmark results, appended as JSON lines so that regressions show up.
+
+    python -m benchmarks.history [--path benchmarks/results.jsonl]
+
+prints the last two runs of every benchmark and their difference. The
+results depend on the machine, the file is local (ignored by git).
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+from typing import Dict, Iterator
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), 'results.jsonl')
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def record(benchmark: str, params: Dict, metrics: Dict,
+           path: str = DEFAULT_PATH) -> Dict:
+    entry = {
+        'benchmark': benchmark,
+        'params': params,
+        'metrics': metrics,
+        'revision': get_revision(),
+        'host': platform.node(),
+        'time': datetime.datetime.utcnow().isoformat(),
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    print(json.dumps(entry, indent=2))
+    return entry
+
+
+def read(path: str = DEFAULT_PATH) -> Iterator[Dict]:
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def compare(path: str = DEFAULT_PATH):
+    runs = {}
+    for entry in read(path):
+        key = (entry['benchmark'], json.dumps(entry['params'],
+                                              sort_keys=True))
+        runs.setdefault(key, []).append(entry)
+    for (benchmark, params), entries in sorted(runs.items()):
+        print('%s %s' % (benchmark, params))
+        *_, before, after = [None] + entries
+        for name, value in sorted(after['metrics'].items()):
+            previous = before['metrics'].get(name) if before else None
+            if isinstance(value, (int, float)) \
+                    and isinstance(previous, (int, float)) and previous:
+                print('    %-24s %12.4f  (%+.1f%% since %s)' % (
+                    name, value, (value - previous) / previous * 100,
+                    before['revision']))
+            else:
+                print('    %-24s %12s' % (name, value))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=DEFAULT_PATH)
+    args = parser.parse_args()
+    compare(args.path)
+
+
+if __name__ == '__main__':
+    main()
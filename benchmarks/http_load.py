@@ -0,0 +1,115 @@
+# coding=utf-8
+"""Closed-loop HTTP load generator for the gateway.
+
+Run it against two builds of the gateway to compare them, e.g.
+
+    python -m benchmarks.http_load --url http://127.0.0.1:8080 \\
+        --concurrency 200 --duration 30 /record/<paper_id> /search/record?...
+
+and add `--record <name>` to keep the result in benchmarks/results.jsonl.
+See benchmarks/gateway.py to serve the gateway on in-memory stores.
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+from typing import List, Dict
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(q * len(sorted_values)))]
+
+
+def run_load(url: str, paths: List[str], concurrency: int, duration: float,
+             method: str = 'GET', headers: Dict[str, str] = None) -> Dict:
+    parsed = urllib.parse.urlsplit(url)
+    deadline = time.time() + duration
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(n: int):
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80,
+                                          timeout=60)
+        local_latencies = []
+        local_errors = 0
+        i = n
+        while time.time() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                conn.request(method, parsed.path.rstrip('/') + path,
+                             headers=headers or {})
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status >= 500:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection(
+                    parsed.hostname, parsed.port or 80, timeout=60)
+                continue
+            local_latencies.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    started = time.time()
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True)
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'url': url,
+        'paths': paths,
+        'method': method,
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--method', default='GET')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--cookie', default=None,
+                        help="e.g. session=<key> to exercise logged-in paths")
+    parser.add_argument('--record', default=None, metavar='NAME',
+                        help="append the result to benchmarks/results.jsonl")
+    args = parser.parse_args()
+
+    headers = {'Cookie': args.cookie} if args.cookie else {}
+    result = run_load(args.url, args.paths, args.concurrency,
+                      args.duration, args.method, headers)
+    if args.record:
+        from benchmarks import history
+        params = {key: result.pop(key) for key in
+                  ('url', 'paths', 'method', 'concurrency')}
+        history.record(args.record, params, result)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
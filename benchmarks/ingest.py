@@ -0,0 +1,87 @@
+# coding=utf-8
+"""Ingestion throughput of the datafeeder pipeline.
+
+Run from the repository root, against the Mongo/Redis of
+celery_workers/global-config.ini or, with --fakes, in-memory stand-ins:
+
+    python -m benchmarks.ingest --records 200000 --parallelism 0,2,4 --fakes
+
+Every parallelism setting ingests the same synthetic corpus under a fresh
+run id; records/s covers the parse, transform and bulk write stages and
+authors/s the final merge. The records and authors are upserted, point
+[db] db_name to a scratch database when not using --fakes.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from celery_workers.datafeeder import conf
+from celery_workers.datafeeder import authors, pipeline, tasks
+from benchmarks import fakes, history, s2corpus
+
+
+def run(paths, parallelism: int, batch_size: int,
+        max_in_flight_writes: int) -> dict:
+    run_id = tasks.new_run_id()
+    n_records = 0
+    start = time.perf_counter()
+    with pipeline.IngestPipeline(run_id, batch_size, parallelism,
+                                 max_in_flight_writes) as ingest:
+        for path in paths:
+            n_records += ingest.process_file(path)
+    ingest_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n_authors = authors.write_authors(run_id)
+    merge_seconds = time.perf_counter() - start
+    return {
+        'records': n_records,
+        'ingest_seconds': ingest_seconds,
+        'records_per_second': n_records / ingest_seconds,
+        'merge_seconds': merge_seconds,
+        'authors_per_second': n_authors / merge_seconds
+        if merge_seconds else 0.,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default=None,
+                        help="directory of .gz files, generated if omitted")
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--parallelism', default='0,%s'
+                        % conf['ingest']['parallelism'])
+    parser.add_argument('--batch-size', type=int,
+                        default=int(conf['ingest']['batch_size']))
+    parser.add_argument('--max-in-flight-writes', type=int,
+                        default=int(conf['ingest']['max_in_flight_writes']))
+    parser.add_argument('--fakes', action='store_true')
+    args = parser.parse_args()
+
+    if args.fakes:
+        fakes.install()
+    with tempfile.TemporaryDirectory() as tmp:
+        conf['authors']['run_root'] = os.path.join(tmp, 'author-runs')
+        if args.corpus:
+            paths = sorted(os.path.join(args.corpus, name)
+                           for name in os.listdir(args.corpus)
+                           if name.endswith('.gz'))
+        else:
+            paths = s2corpus.generate(os.path.join(tmp, 's2'), args.files,
+                                      args.records)
+        for parallelism in map(int, args.parallelism.split(',')):
+            history.record('ingest', {
+                'files': len(paths),
+                'corpus': args.corpus or 'synthetic-%d' % args.records,
+                'parallelism': parallelism,
+                'batch_size': args.batch_size,
+                'max_in_flight_writes': args.max_in_flight_writes,
+                'fakes': args.fakes,
+            }, run(paths, parallelism, args.batch_size,
+                   args.max_in_flight_writes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# coding=utf-8
+"""Microbenchmarks of the recommender on a synthetic model.
+
+Run from the repository root, with in-memory Mongo/Redis (--fakes) or the
+ones of celery_workers/global-config.ini:
+
+    python -m benchmarks.recommender --papers 200000 --fakes
+
+Covers the stages of `recommender.recommend` one by one (author profile
+fetch, clustering, faiss search, re-rank), the faiss index types and the
+whole task, run eagerly.
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+
+import gensim
+import numpy as np
+
+from celery_workers.recommender import app, conf
+from celery_workers.recommender import clustering, indexes, profiles, \
+    ranking, tasks
+from celery_workers.recommender.artifacts import Model, model_holder
+from benchmarks import fakes, history
+from benchmarks.s2corpus import paper_id
+
+
+def timed(func: Callable, repeat: int) -> Dict:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'mean_ms': float(np.mean(latencies) * 1000),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+    }
+
+
+def make_model(n_papers: int, n_topics: int = 100,
+               seed: int = 0) -> Model:
+    # papers gathered around topics, like the embeddings of a citation graph
+    rng = np.random.default_rng(seed)
+    dim = int(conf['faiss']['dimension'])
+    topics = rng.normal(size=(n_topics, dim))
+    vectors = topics[rng.integers(n_topics, size=n_papers)] \
+        + rng.normal(scale=0.3, size=(n_papers, dim))
+    wv = gensim.models.KeyedVectors(dim)
+    wv.add_vectors([paper_id(n) for n in range(n_papers)],
+                   vectors.astype(np.float32))
+    index = indexes.build_index(wv.get_normed_vectors())
+    return Model('benchmark', wv, index)
+
+
+def seed_author(model: Model, author_id: int, n_papers: int,
+                n_citations: int, rng: np.random.Generator):
+    paper_ids = [model.wv.index_to_key[i]
+                 for i in rng.integers(len(model.wv), size=n_papers)]
+    for paper in paper_ids:
+        profiles.t_records.replace_one({'_id': paper}, {
+            '_id': paper,
+            'outCitations': [model.wv.index_to_key[i] for i in rng.integers(
+                len(model.wv), size=n_citations)],
+        }, upsert=True)
+    profiles.t_authors.replace_one(
+        {'_id': author_id}, {'_id': author_id, 'papers': paper_ids},
+        upsert=True)
+
+
+def bench_stages(model: Model, author_paper_counts: List[int],
+                 repeat: int, fake: bool):
+    rng = np.random.default_rng(1)
+    seeds = rng.integers(len(model.wv), size=repeat)
+    for author_id, n_papers in enumerate(author_paper_counts):
+        seed_author(model, author_id, n_papers, 20, rng)
+        params = {'papers': len(model.wv), 'author_papers': n_papers,
+                  'fakes': fake}
+
+        def fetch():
+            profiles.author_profile_cache.clear()
+            return profiles.get_author_interest_vectors(model.wv, author_id)
+
+        history.record('recommend.profile_fetch', params, timed(fetch, repeat))
+        vectors = fetch()
+        for algorithm in clustering.ALGORITHMS:
+            history.record('recommend.clustering',
+                           dict(params, algorithm=algorithm,
+                                vectors=len(vectors)),
+                           timed(lambda: clustering.cluster_interest_vectors(
+                               vectors, algorithm), repeat))
+
+        profile = clustering.cluster_interest_vectors(vectors)[0] \
+            .mean(axis=0, keepdims=True).astype(np.float32)
+        queries = ranking.gather_normed_vectors(model.wv, seeds) \
+            .astype(np.float32)
+        top_k = int(conf['faiss']['search_top_k'])
+        history.record('recommend.faiss_search', params, timed(
+            lambda: model.index.search(queries[:1], top_k), repeat))
+        history.record('recommend.rank', params, timed(
+            lambda: ranking.rank(model, seeds[:1], profile), repeat))
+
+        # the whole task as the gateway sends it, results stored in redis
+        history.record('recommend.task', params, timed(
+            lambda: tasks.task_recommend.apply(
+                args=(author_id, model.wv.index_to_key[seeds[0]])),
+            repeat))
+
+    for batch_size in (1, 16, 256):
+        history.record('recommend.rank_batch',
+                       {'papers': len(model.wv), 'batch_size': batch_size},
+                       timed(lambda: ranking.rank(model, seeds[:batch_size]),
+                             max(repeat // batch_size, 3)))
+
+
+def bench_index_types(model: Model, index_types: List[str],
+                      metrics: List[str], n_queries: int):
+    for result in indexes.evaluate_index_types(
+            model.wv.get_normed_vectors(), index_types, metrics, n_queries,
+            int(conf['faiss']['search_top_k'])):
+        params = {'papers': len(model.wv),
+                  'index_type': result.pop('index_type'),
+                  'metric': result.pop('metric')}
+        history.record('faiss.index_type', params, result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=100000)
+    parser.add_argument('--author-papers', default='10,100,1000')
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--index-types',
+                        default=conf['faiss_eval']['index_types'])
+    parser.add_argument('--metrics', default=conf['faiss']['metric'])
+    parser.add_argument('--fakes', action='store_true')
+    args = parser.parse_args()
+
+    if args.fakes:
+        fakes.install()
+    fakes.eager(app)
+    model = make_model(args.papers)
+    # keep the synthetic model, whatever CURRENT points to
+    model_holder.check_interval = float('inf')
+    model_holder.set(model)
+    bench_stages(model, list(map(int, args.author_papers.split(','))),
+                 args.repeat, args.fakes)
+    bench_index_types(model, args.index_types.split(','),
+                      args.metrics.split(','), min(args.repeat * 10,
+                                                   args.papers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# coding=utf-8
+"""Synthetic Semantic Scholar corpus, in the gzipped JSON lines format that
+`datafeeder.process_s2` reads.
+
+    python -m benchmarks.s2corpus /tmp/s2 --files 10 --records 100000
+
+writes s2-corpus-000.gz ... s2-corpus-009.gz, matching the `*<i>.gz` patterns
+of `datafeeder.distributed_process_s2_then_train_model`.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+from typing import Dict, List
+
+WORDS = ('learning neural network graph deep model data analysis system '
+         'distributed query optimization language semantic retrieval '
+         'embedding citation recommendation scalable efficient robust '
+         'adversarial inference probabilistic parallel storage index '
+         'compiler verification security privacy wireless sensor vision '
+         'reinforcement transformer clustering benchmark streaming').split()
+FIELDS = ['Computer Science', 'Mathematics', 'Medicine', 'Physics']
+
+
+def paper_id(n: int) -> str:
+    return hashlib.sha1(b'paper-%d' % n).hexdigest()
+
+
+def make_record(n: int, n_records: int, n_authors: int,
+                rng: random.Random) -> Dict:
+    # citations mostly go to older papers, the way real ones do
+    def cited(k: int) -> List[str]:
+        return [paper_id(rng.randrange(max(n, 1))) for _ in range(k)] \
+            if n else []
+
+    return {
+        'id': paper_id(n),
+        'title': ' '.join(rng.choice(WORDS).capitalize()
+                          for _ in range(rng.randint(4, 12))),
+        'paperAbstract': ' '.join(rng.choice(WORDS)
+                                  for _ in range(rng.randint(50, 200))),
+        'entities': [],
+        's2Url': 'https://semanticscholar.org/paper/%s' % paper_id(n),
+        's2PdfUrl': '',
+        'pdfUrls': [],
+        'authors': [{'name': 'Author %d' % a, 'ids': [str(a)]}
+                    for a in rng.sample(range(n_authors),
+                                        rng.randint(1, 6))],
+        'inCitations': [paper_id(rng.randrange(n_records))
+                        for _ in range(rng.randint(0, 20))],
+        'outCitations': cited(rng.randint(0, 30)),
+        # three quarters of the papers are kept by the ingestion
+        'fieldsOfStudy': [rng.choice(FIELDS) if rng.random() < 0.33
+                          else 'Computer Science'],
+        'year': rng.randint(1970, 2021),
+        'venue': rng.choice(['', 'SIGMOD', 'NeurIPS', 'OSDI', 'ACL']),
+        'journalName': '',
+        'journalVolume': '',
+        'journalPages': ' %d-%d ' % (n % 100, n % 100 + 10),
+        'sources': ['DBLP'],
+        'doi': '10.0000/%d' % n if rng.random() < 0.8 else '',
+        'doiUrl': '',
+        'pmid': '',
+        'magId': str(n),
+    }
+
+
+def generate(directory: str, n_files: int, n_records: int,
+             n_authors: int = None, seed: int = 0) -> List[str]:
+    # n_records in total, spread over the files
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    n_authors = n_authors or max(n_records // 5, 1)
+    paths = []
+    per_file = -(-n_records // n_files)
+    for i in range(n_files):
+        path = os.path.join(directory, 's2-corpus-%03d.gz' % i)
+        with gzip.open(path, 'wb') as f:
+            for n in range(i * per_file, min((i + 1) * per_file, n_records)):
+                f.write(json.dumps(make_record(n, n_records, n_authors, rng))
+                        .encode() + b'\n')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory')
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--authors', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for path in generate(args.directory, args.files, args.records,
+                         args.authors, args.seed):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,13 @@
 
 time_zone = 'UTC'
 
+# expire results in the backend itself instead of forgetting them by hand
+result_expires = 3600
+
+# the recommender children load the (memory mapped) model when they start,
+# see [artifacts] load_on_start
+worker_proc_alive_timeout = 60
+
 task_annotations = {
     "authors.append_orcid": {"rate_limit": '22/s'},  # orcid limits
 }
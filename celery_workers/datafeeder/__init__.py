@@ -22,12 +22,17 @@ t_dblp = db['dblp']  # type: pymongo.database.Collection
 t_arxiv = db['arxiv']  # type: pymongo.database.Collection
 t_records = db['records']  # type: pymongo.database.Collection
 t_authors = db['authors']  # type: pymongo.database.Collection
+t_ingest_checkpoints = db['ingest_checkpoints']  # type: pymongo.database.Collection
 
-t_records.create_index([("title", pymongo.TEXT)], name="text-search-title")
+# indexes are built by celery_workers/migrations.py
 
 r = redis.Redis(host=conf['redis']['host'],
                 port=conf['redis']['port'],
                 db=conf['redis']['db'])
+# the redis db of the gateway (record cache, title autocomplete)
+r_gateway = redis.Redis(host=conf['redis']['host'],
+                        port=conf['redis']['port'],
+                        db=conf['gateway_redis']['db'])
 
 app = celery.Celery("datafeeder",
                     backend=f"redis://{conf['redis']['host']}"
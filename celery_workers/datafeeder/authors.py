@@ -0,0 +1,122 @@
+# coding=utf-8
+import heapq
+import itertools
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Tuple
+
+from pymongo import UpdateOne
+
+from celery_workers.datafeeder import conf, logger, t_authors
+from celery_workers.metrics import BULK_WRITE_SECONDS
+
+
+__all__ = ['AuthorPapers', 'AuthorAggregator', 'get_run_dir',
+           'iter_merged_authors', 'write_authors']
+
+
+AuthorPapers = Dict[int, Tuple[str, List[str]]]
+
+
+def get_run_dir(run_id: str) -> str:
+    return os.path.join(conf['authors']['run_root'], run_id)
+
+
+class AuthorAggregator:
+    # Collects author -> (name, paper ids) in memory and, past
+    # max_buffered_papers, spills them as a run file sorted by author id
+    # (one json [id, name, papers] per line). The runs of all the tasks of
+    # an ingestion are merged by iter_merged_authors at the end.
+    def __init__(self, run_dir: str, prefix: str,
+                 max_buffered_papers: int = None):
+        self.run_dir = run_dir
+        self.prefix = prefix
+        self.max_buffered_papers = max_buffered_papers \
+            or int(conf['authors']['max_buffered_papers'])
+        self.buffered = {}  # type: AuthorPapers
+        self.n_buffered_papers = 0
+        self.n_runs = 0
+        os.makedirs(run_dir, exist_ok=True)
+
+    def discard(self):
+        # drop the runs a previous, interrupted attempt left with our prefix
+        for name in os.listdir(self.run_dir):
+            if name.startswith(self.prefix + '.'):
+                os.remove(os.path.join(self.run_dir, name))
+
+    def add(self, author_papers: AuthorPapers):
+        for id, (name, papers) in author_papers.items():
+            if id not in self.buffered:
+                self.buffered[id] = (name, list(papers))
+            else:
+                self.buffered[id][1].extend(papers)
+            self.n_buffered_papers += len(papers)
+        if self.n_buffered_papers >= self.max_buffered_papers:
+            self.spill()
+
+    def spill(self):
+        if not self.buffered:
+            return
+        path = os.path.join(self.run_dir,
+                            '%s.%d.jsonl' % (self.prefix, self.n_runs))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for id in sorted(self.buffered):
+                name, papers = self.buffered[id]
+                f.write(json.dumps([id, name, papers]))
+                f.write('\n')
+        os.replace(tmp_path, path)
+        self.n_runs += 1
+        self.buffered.clear()
+        self.n_buffered_papers = 0
+
+
+def _read_run(path: str) -> Iterator[List]:
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def iter_merged_authors(run_dir: str) -> Iterator[Tuple[int, str, List[str]]]:
+    try:
+        names = sorted(os.listdir(run_dir))
+    except FileNotFoundError:
+        # merged already by another task of the run
+        return
+    runs = [_read_run(os.path.join(run_dir, name))
+            for name in names if name.endswith('.jsonl')]
+    merged = heapq.merge(*runs, key=lambda item: item[0])
+    for id, items in itertools.groupby(merged, key=lambda item: item[0]):
+        name = None
+        papers = {}
+        for _, item_name, item_papers in items:
+            name = name or item_name
+            papers.update(dict.fromkeys(item_papers))
+        yield id, name, list(papers)
+
+
+def write_authors(run_id: str, batch_size: int = None) -> int:
+    # every author is written exactly once, the papers added to those of
+    # the previous ingestions
+    batch_size = batch_size or int(conf['authors']['write_batch_size'])
+    run_dir = get_run_dir(run_id)
+    n_authors = 0
+    requests = []
+    for id, name, papers in iter_merged_authors(run_dir):
+        requests.append(UpdateOne({'_id': id},
+                                  {'$set': {'name': name},
+                                   '$addToSet': {'papers': {'$each': papers}}},
+                                  upsert=True))
+        if len(requests) >= batch_size:
+            with BULK_WRITE_SECONDS.labels('authors').time():
+                t_authors.bulk_write(requests, ordered=False)
+            n_authors += len(requests)
+            requests = []
+    if requests:
+        with BULK_WRITE_SECONDS.labels('authors').time():
+            t_authors.bulk_write(requests, ordered=False)
+        n_authors += len(requests)
+    logger.info("[authors] %d authors of run %s written", n_authors, run_id)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    return n_authors
@@ -0,0 +1,57 @@
+# coding=utf-8
+import os
+import threading
+import time
+from typing import Dict
+
+from celery_workers.datafeeder import t_ingest_checkpoints
+
+
+__all__ = ['FileCheckpoint', 'OffsetTracker']
+
+
+class FileCheckpoint:
+    # Progress of one file within one ingestion run: `offset` is the number
+    # of leading lines whose records are known to be written, `done` is set
+    # once the whole file, authors included, is processed.
+    def __init__(self, run_id: str, filepath: os.PathLike):
+        self.key = '%s:%s' % (run_id, filepath)
+        doc = t_ingest_checkpoints.find_one({'_id': self.key}) or {}
+        self.run_id = run_id
+        self.filepath = str(filepath)
+        self.offset = doc.get('offset', 0)  # type: int
+        self.done = doc.get('done', False)  # type: bool
+
+    def _save(self, **fields):
+        fields.update(run_id=self.run_id, path=self.filepath,
+                      updated=time.time())
+        t_ingest_checkpoints.update_one({'_id': self.key}, {'$set': fields},
+                                        upsert=True)
+
+    def commit(self, offset: int):
+        self.offset = offset
+        self._save(offset=offset)
+
+    def finish(self):
+        self.done = True
+        self._save(offset=self.offset, done=True)
+
+
+class OffsetTracker:
+    # Batches are written out of order, the checkpoint only advances over
+    # the batches that are all written.
+    def __init__(self, checkpoint: FileCheckpoint):
+        self.checkpoint = checkpoint
+        self.next_batch = 0
+        self.completed = {}  # type: Dict[int, int]
+        self.lock = threading.Lock()
+
+    def complete(self, batch_no: int, end: int):
+        with self.lock:
+            self.completed[batch_no] = end
+            offset = None
+            while self.next_batch in self.completed:
+                offset = self.completed.pop(self.next_batch)
+                self.next_batch += 1
+            if offset is not None and offset > self.checkpoint.offset:
+                self.checkpoint.commit(offset)
@@ -0,0 +1,217 @@
+# coding=utf-8
+import collections
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+import billiard
+from pymongo import ReplaceOne
+from celery_workers.datafeeder import conf, logger, t_records
+from celery_workers.datafeeder.authors import AuthorPapers, \
+    AuthorAggregator, get_run_dir
+from celery_workers.datafeeder.checkpoints import FileCheckpoint, \
+    OffsetTracker
+from celery_workers.datafeeder.utils import explain_second, \
+    invalidate_record_cache
+from celery_workers.metrics import BULK_WRITE_SECONDS, INGEST_RECORDS
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+__all__ = ['transform_record', 'transform_batch', 'read_batches',
+           'BulkWriter', 'IngestPipeline']
+
+
+def transform_record(record: Dict) -> Dict:
+    del record['entities']
+    del record['s2Url']
+    del record['s2PdfUrl']
+    del record['doiUrl']
+    del record['sources']
+    record['journalPages'] = record['journalPages'].strip()
+    record['_id'] = record.pop('id')
+    # lets the recommender train incrementally on what changed
+    record['ingestedAt'] = datetime.datetime.utcnow()
+    return record
+
+
+def transform_batch(lines: List[bytes]) -> Tuple[List[Dict], AuthorPapers]:
+    # runs in the pool processes, on the lines kept by read_batches
+    records = []
+    author_papers = {}
+    for line in lines:
+        record = transform_record(json_loads(line))
+        paper_id = record['_id']
+        for author in record['authors']:
+            author_name = author['name']
+            for a_id in author['ids']:
+                id = int(a_id)
+                if id not in author_papers:
+                    author_papers[id] = (author_name, [paper_id])
+                else:
+                    author_papers[id][1].append(paper_id)
+        records.append(record)
+    return records, author_papers
+
+
+def read_batches(filepath: os.PathLike,
+                 batch_size: int) -> Iterator[Tuple[int, int, List[bytes]]]:
+    # Yields (start line, end line, lines) every batch_size lines of the
+    # file, with only the Computer Science ones: the others are dropped
+    # before being parsed or sent to the pool. The offsets count every line.
+    with gzip.open(filepath, "rb") as f:
+        start = end = 0
+        batch = []
+        for line in f:
+            end += 1
+            if b'Computer Science' in line:
+                batch.append(line)
+            if end - start >= batch_size:
+                yield start, end, batch
+                start, batch = end, []
+        if end > start:
+            yield start, end, batch
+
+
+class BulkWriter:
+    # Runs bulk writes in threads, at most `max_in_flight` of them at once;
+    # `submit` blocks when that many are already running.
+    def __init__(self, max_in_flight: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight,
+                                           thread_name_prefix='bulk-writer')
+        self.semaphore = threading.BoundedSemaphore(max_in_flight)
+        self.futures = []  # type: List[Future]
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        self.semaphore.acquire()
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda _: self.semaphore.release())
+        self.futures.append(future)
+        self.futures = [f for f in self.futures if not f.done()
+                        or f.exception() is not None]
+        return future
+
+    def join(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def write_records(records: List[Dict]):
+    # upserts, so that replaying a batch after a crash is harmless
+    with BULK_WRITE_SECONDS.labels('records').time():
+        t_records.bulk_write([ReplaceOne({'_id': record['_id']}, record,
+                                         upsert=True)
+                              for record in records], ordered=False)
+    INGEST_RECORDS.inc(len(records))
+    invalidate_record_cache(records)
+
+
+def get_file_prefix(filepath: os.PathLike) -> str:
+    return '%s-%s' % (os.path.basename(filepath),
+                      hashlib.md5(str(filepath).encode()).hexdigest()[:8])
+
+
+class IngestPipeline:
+    # reader (this thread) -> parse/transform (process pool) -> bulk writes
+    # (thread pool), all three stages overlapping
+    def __init__(self,
+                 run_id: str,
+                 batch_size: int = None,
+                 parallelism: int = None,
+                 max_in_flight_writes: int = None):
+        self.run_id = run_id
+        self.batch_size = batch_size or int(conf['ingest']['batch_size'])
+        self.parallelism = parallelism if parallelism is not None \
+            else int(conf['ingest']['parallelism'])
+        self.max_in_flight_writes = max_in_flight_writes \
+            or int(conf['ingest']['max_in_flight_writes'])
+        self.pool = None
+        self.writer = None
+
+    def __enter__(self):
+        if self.parallelism > 0:
+            # billiard, unlike multiprocessing, allows children in the
+            # daemonic celery worker processes
+            self.pool = billiard.Pool(processes=self.parallelism)
+        self.writer = BulkWriter(self.max_in_flight_writes)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.pool is not None:
+            self.pool.terminate() if exc_type else self.pool.close()
+            self.pool.join()
+        self.writer.shutdown()
+
+    def transformed_batches(self, filepath: os.PathLike):
+        # yields (end line, records, author papers) in the file order
+        if self.pool is None:
+            for _, end, lines in read_batches(filepath, self.batch_size):
+                yield (end,) + transform_batch(lines)
+            return
+
+        pending = collections.deque()
+        for _, end, lines in read_batches(filepath, self.batch_size):
+            if not lines:
+                # nothing to ship to the pool, kept for the offsets
+                pending.append((end, None))
+            else:
+                pending.append(
+                    (end, self.pool.apply_async(transform_batch, (lines,))))
+            if len(pending) >= 2 * self.parallelism:
+                end, result = pending.popleft()
+                yield (end,) + (result.get() if result else ([], {}))
+        while pending:
+            end, result = pending.popleft()
+            yield (end,) + (result.get() if result else ([], {}))
+
+    def process_file(self, filepath: os.PathLike) -> int:
+        checkpoint = FileCheckpoint(self.run_id, filepath)
+        if checkpoint.done:
+            logger.debug("Skipped %s, already processed", filepath)
+            return 0
+        if checkpoint.offset:
+            logger.debug("Resuming %s from line %d",
+                         filepath, checkpoint.offset)
+
+        # the authors of a file are aggregated again from its very first
+        # line, only the records already written are skipped
+        authors = AuthorAggregator(get_run_dir(self.run_id),
+                                   get_file_prefix(filepath))
+        authors.discard()
+        tracker = OffsetTracker(checkpoint)
+
+        last_time = time.time()
+        n_records = 0
+        batches = self.transformed_batches(filepath)
+        for batch_no, (end, records, author_papers) in enumerate(batches):
+            authors.add(author_papers)
+            if end <= checkpoint.offset or not records:
+                tracker.complete(batch_no, end)
+                continue
+            n_records += len(records)
+            future = self.writer.submit(write_records, records)
+            future.add_done_callback(
+                lambda f, batch_no=batch_no, end=end:
+                f.exception() is None and tracker.complete(batch_no, end))
+        self.writer.join()
+        authors.spill()
+        checkpoint.finish()
+        time_diff = time.time() - last_time
+        logger.debug("Processed %s (%d records) in %s, %.0f records/s",
+                     filepath, n_records, explain_second(time_diff),
+                     n_records / time_diff if time_diff else 0)
+        return n_records
@@ -1,87 +1,84 @@
 # coding=utf-8
 import glob
-import gzip
-import json
 import os
 import time
-from typing import Dict, List, Optional
+import uuid
+from typing import List, Optional
 
 import celery
-from pymongo import UpdateOne
 
+from celery_workers import migrations
 from celery_workers.datafeeder import *
+from celery_workers.datafeeder.authors import *
+from celery_workers.datafeeder.pipeline import *
 from celery_workers.datafeeder.utils import *
 
 
 @app.task(name="datafeeder.process_s2")
 def task_process_s2(paths: Optional[List[os.PathLike]] = None,
                     pattern: Optional[str] = None,
-                    run_next_task: bool = False):
+                    run_next_task: bool = False,
+                    run_id: Optional[str] = None,
+                    merge_authors: bool = True):
+    # Authors are aggregated into sorted runs under the run_id directory;
+    # tasks sharing a run_id leave the merge to datafeeder.merge_authors.
+    # Rerunning with the same run_id skips the files already processed and
+    # resumes the others from their last written batch.
     assert paths or pattern
     if paths is None:
         paths = glob.glob(os.path.join('/data/s2', pattern))
+    run_id = run_id or new_run_id()
 
-    for i, filepath in enumerate(paths):
-        with gzip.open(filepath, "rb") as f:
-            buffered_records = []
-            buffered_author_papers = {}
-            with dbclient.start_session(causal_consistency=True) as session:
-                last_time = time.time()
-                for line in f:
-                    if b'Computer Science' not in line:
-                        continue
-                    record = json.loads(line)
-                    del record['entities']
-                    del record['s2Url']
-                    del record['s2PdfUrl']
-                    del record['doiUrl']
-                    del record['sources']
-                    record['journalPages'] = record['journalPages'].strip()
-                    record['_id'] = paper_id = record.pop('id')
-                    for author in record['authors']:
-                        author_name = author['name']
-                        for a_id in author['ids']:
-                            id = int(a_id)
-                            if id not in buffered_author_papers:
-                                buffered_author_papers[id] = \
-                                    (author_name, [paper_id])
-                            else:
-                                buffered_author_papers[id][1].append(paper_id)
-
-                    buffered_records.append(record)
-                    if len(buffered_records) >= 1000:
-                        t_records.insert_many(buffered_records,
-                                              ordered=False, session=session)
-                        buffered_records.clear()
-                        t_authors.bulk_write([
-                            UpdateOne({"_id": k},
-                                      {"$push": {"papers": {"$each": v[1]}},
-                                       "$setOnInsert": {"name": v[0]}},
-                                      upsert=True)
-                            for k, v in buffered_author_papers.items()
-                        ], ordered=False, session=session)
-                        buffered_author_papers.clear()
-
-                time_diff = time.time() - last_time
-                logger.debug(
-                    "[%d/%d] Processed %s file in %s",
-                    i + 1, len(paths), filepath, explain_second(time_diff))
-
-                if buffered_records:
-                    t_records.insert_many(buffered_records,
-                                          ordered=False, session=session)
-                    buffered_records.clear()
-                    t_authors.bulk_write([
-                        UpdateOne({"_id": k},
-                                  {"$push": {"papers": {"$each": v[1]}},
-                                   "$setOnInsert": {"name": v[0]}},
-                                  upsert=True)
-                        for k, v in buffered_author_papers.items()
-                    ], ordered=False, session=session)
-                    buffered_author_papers.clear()
+    with IngestPipeline(run_id) as pipeline:
+        for i, filepath in enumerate(paths):
+            logger.debug("[%d/%d] Processing %s", i + 1, len(paths), filepath)
+            pipeline.process_file(filepath)
+
+    if merge_authors:
+        write_authors(run_id)
 
     if run_next_task:
-        app.send_task('recommender.process_database').forget()
+        app.send_task('recommender.update_model').forget()
+
+
+def new_run_id() -> str:
+    return time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+
+
+@app.task(name="datafeeder.merge_authors")
+def task_merge_authors(run_id: str):
+    write_authors(run_id)
+
+
+@app.task(name="datafeeder.build_title_autocomplete")
+def task_build_title_autocomplete():
+    # A lexicographically sorted set of "<normalized title>\0<_id>\0<title>"
+    # members, so that a prefix lookup is a single ZRANGEBYLEX. Built aside
+    # and renamed over the previous one.
+    max_length = int(conf['autocomplete']['max_title_length'])
+    tmp_key = TITLE_AUTOCOMPLETE_KEY + '-building'
+    r_gateway.delete(tmp_key)
+    pipe = r_gateway.pipeline(transaction=False)
+    n = 0
+    for record in t_records.find({}, {'title': 1}):
+        title = (record.get('title') or '').strip()
+        if not title:
+            continue
+        member = '\0'.join([normalize_title(title)[:max_length],
+                             record['_id'], title[:max_length]])
+        pipe.zadd(tmp_key, {member: 0})
+        n += 1
+        if n % 10000 == 0:
+            pipe.execute()
+    pipe.execute()
+    if n:
+        r_gateway.rename(tmp_key, TITLE_AUTOCOMPLETE_KEY)
+    logger.info("[autocomplete] %d titles indexed", n)
+
+
+@app.task(name="datafeeder.create_indexes")
+def task_create_indexes(dry_run: bool = False):
+    return migrations.create_indexes(db, dry_run)
 
 
 @app.task(name="proxy_recommender.process_database")
@@ -89,9 +86,20 @@ def task_proxy_recommender_process_database(*args, **kwargs):
     app.send_task('recommender.process_database').forget()
 
 
+@app.task(name="proxy_recommender.update_model")
+def task_proxy_recommender_update_model(*args, **kwargs):
+    app.send_task('recommender.update_model').forget()
+
+
 @app.task(name="datafeeder.distributed_process_s2_then_train_model")
-def task_distributed_process_s2_then_train_model():
-    callback = task_proxy_recommender_process_database.s()
-    header = [task_process_s2.s(pattern='*%d.gz' % i) for i in range(10)]
+def task_distributed_process_s2_then_train_model(run_id: Optional[str] = None):
+    # pass the run_id of an interrupted ingestion to resume it
+    run_id = run_id or new_run_id()
+    callback = celery.chain(task_merge_authors.si(run_id),
+                            task_build_title_autocomplete.si(),
+                            task_proxy_recommender_update_model.si())
+    header = [task_process_s2.s(pattern='*%d.gz' % i, run_id=run_id,
+                                merge_authors=False)
+              for i in range(10)]
     result = celery.chord(header)(callback)
 
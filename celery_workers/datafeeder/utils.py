@@ -1,7 +1,16 @@
 # coding=utf-8
+import json
+from typing import Iterable, Dict
+
 import requests
 
-from celery_workers.datafeeder import conf
+from celery_workers.datafeeder import conf, r_gateway
+
+# keep in sync with gateways/cache.py
+RECORD_CACHE_KEY_FORMAT = "record-cache-%s"
+RECORD_CACHE_INVALIDATION_CHANNEL = "record-cache-invalidate"
+# keep in sync with gateways/main.py
+TITLE_AUTOCOMPLETE_KEY = "autocomplete-titles"
 
 
 def download(url: str, path: str) -> str:
@@ -28,3 +37,21 @@ def explain_second(secs: float, format: str = "%.2f"):
             break
         value /= unit_scale
     return (format % value) + unit_name
+
+
+def invalidate_record_cache(records: Iterable[Dict]):
+    keys = []
+    for record in records:
+        keys.append(record['_id'])
+        if record.get('doi'):
+            keys.append('doi:' + record['doi'])
+    if not keys:
+        return
+    pipe = r_gateway.pipeline(transaction=False)
+    pipe.delete(*[RECORD_CACHE_KEY_FORMAT % key for key in keys])
+    pipe.publish(RECORD_CACHE_INVALIDATION_CHANNEL, json.dumps(keys))
+    pipe.execute()
+
+
+def normalize_title(title: str) -> str:
+    return ' '.join(title.lower().split())
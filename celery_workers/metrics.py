@@ -0,0 +1,144 @@
+# coding=utf-8
+import configparser
+import glob
+import logging
+import os
+import time
+
+from celery.utils.log import get_task_logger
+
+conf = configparser.ConfigParser()
+conf.read_file(open("celery_workers/global-config.ini"))
+
+# Must be set before prometheus_client is imported: the prefork children
+# write their samples there and the main process of the worker serves the
+# aggregate of all of them.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                      conf['metrics']['multiproc_dir'])
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+import celery.signals  # noqa: E402
+from prometheus_client import CollectorRegistry, Counter, Gauge, \
+    Histogram, multiprocess, start_http_server  # noqa: E402
+from prometheus_client.core import GaugeMetricFamily  # noqa: E402
+
+
+__all__ = ['TASK_SECONDS', 'RECOMMEND_STAGE_SECONDS', 'INGEST_RECORDS',
+           'BULK_WRITE_SECONDS', 'CACHE_LOOKUPS', 'WORKER_STARTUP_SECONDS',
+           'WORKER_RSS_BYTES', 'observe_memory']
+
+logger = get_task_logger(__name__)  # type: logging.Logger
+logger.setLevel(conf['log']['level'])
+
+TASK_SECONDS = Histogram(
+    'conch_task_seconds', "Duration of the celery tasks", ['task'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300,
+             900, 3600, float('inf')))
+RECOMMEND_STAGE_SECONDS = Histogram(
+    'conch_recommend_stage_seconds', "Duration of the recommendation stages",
+    ['stage'],
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1,
+             .25, .5, 1, float('inf')))
+INGEST_RECORDS = Counter(
+    'conch_ingest_records', "Records written by the ingestion")
+BULK_WRITE_SECONDS = Histogram(
+    'conch_bulk_write_seconds', "Latency of the ingestion bulk writes",
+    ['collection'])
+CACHE_LOOKUPS = Counter(
+    'conch_cache_lookups', "Lookups of the worker caches",
+    ['cache', 'result'])
+# per process (pid label), dropped once the process exits
+WORKER_STARTUP_SECONDS = Gauge(
+    'conch_worker_startup_seconds', "Time for a worker process to be ready",
+    multiprocess_mode='liveall')
+WORKER_RSS_BYTES = Gauge(
+    'conch_worker_rss_bytes', "Resident memory of the worker processes, "
+    "anon is private, file is shared through the page cache", ['kind'],
+    multiprocess_mode='liveall')
+
+
+def observe_memory() -> dict:
+    # {kind: bytes} from /proc/self/status, empty elsewhere than on linux
+    memory = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('RssAnon', 'RssFile', 'RssShmem'):
+                    memory[name[3:].lower()] = int(value.split()[0]) * 1024
+    except OSError:
+        return memory
+    for kind, value in memory.items():
+        WORKER_RSS_BYTES.labels(kind).set(value)
+    return memory
+
+
+class QueueDepthCollector:
+    # read from the broker at every scrape, a passive declare doesn't
+    # create the queues
+    def __init__(self, app: celery.Celery, queues):
+        self.app = app
+        self.queues = queues
+
+    def collect(self):
+        messages = GaugeMetricFamily(
+            'conch_queue_messages', "Messages ready in the broker queues",
+            labels=['queue'])
+        consumers = GaugeMetricFamily(
+            'conch_queue_consumers', "Consumers of the broker queues",
+            labels=['queue'])
+        try:
+            with self.app.connection_for_read() as conn:
+                for queue in self.queues:
+                    # a failed passive declare closes its channel
+                    channel = conn.channel()
+                    try:
+                        _, n_messages, n_consumers = channel.queue_declare(
+                            queue=queue, passive=True)
+                    except Exception as e:
+                        logger.warning("[metrics] unable to inspect queue "
+                                       "%s: %s", queue, e)
+                        continue
+                    finally:
+                        channel.close()
+                    messages.add_metric([queue], n_messages)
+                    consumers.add_metric([queue], n_consumers)
+        except Exception as e:
+            logger.warning("[metrics] unable to reach the broker: %s", e)
+        yield messages
+        yield consumers
+
+
+@celery.signals.worker_init.connect
+def start_metrics_server(sender=None, **kwargs):
+    # samples left by the children of a previous run of the worker
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for filename in glob.glob(os.path.join(path, '*.db')):
+        if not filename.endswith('_%d.db' % os.getpid()):
+            os.remove(filename)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(QueueDepthCollector(
+        sender.app, conf['metrics']['queues'].split(',')))
+    start_http_server(int(conf['metrics']['port']), registry=registry)
+    logger.info("[metrics] served on port %s", conf['metrics']['port'])
+
+
+@celery.signals.worker_process_shutdown.connect
+def mark_process_dead(pid=None, **kwargs):
+    multiprocess.mark_process_dead(pid or os.getpid())
+
+
+_task_started = {}
+
+
+@celery.signals.task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+@celery.signals.task_postrun.connect
+def observe_task_time(task_id=None, task=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_SECONDS.labels(task.name).observe(time.perf_counter() - started)
@@ -0,0 +1,95 @@
+# coding=utf-8
+"""Indexes of the Mongo collections, declared next to the queries needing
+them and built once, in the background:
+
+    python -m celery_workers.migrations [--dry-run]
+
+or through the datafeeder.create_indexes task, once per deployment adding
+an index: createIndexes returns only once the build is done (background
+only means the collection stays usable meanwhile). Creating an index that
+exists is a no-op.
+"""
+import argparse
+import logging
+from typing import Dict, List
+
+import pymongo
+import pymongo.database
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+from celery_workers import conf
+
+
+__all__ = ['INDEXES', 'get_db', 'create_indexes']
+
+logger = logging.getLogger(__name__)
+
+
+# collection -> indexes, built in the background (without locking the
+# collection); _id is always indexed
+INDEXES = {
+    'records': [
+        # /search/record
+        IndexModel([('title', TEXT)], name='text-search-title',
+                   background=True),
+        # /record/doi:..., /recommend/batch
+        IndexModel([('doi', ASCENDING)], name='doi',
+                   background=True),
+        # incremental training, corpus fingerprint
+        IndexModel([('ingestedAt', DESCENDING)], name='ingestedAt',
+                   background=True),
+    ],
+    'users': [
+        # login, and registration through its email prefix (duplicates
+        # are checked by the gateway rather than a unique index)
+        IndexModel([('email', ASCENDING), ('hashed_password', ASCENDING)],
+                   name='email-hashed_password',
+                   background=True),
+        IndexModel([('author_id', ASCENDING)], name='author_id',
+                   background=True),
+    ],
+}  # type: Dict[str, List[IndexModel]]
+
+
+def get_db() -> pymongo.database.Database:
+    return pymongo.MongoClient(conf['db']['url'])[conf['db']['db_name']]
+
+
+def create_indexes(db: pymongo.database.Database,
+                   dry_run: bool = False) -> List[str]:
+    # returns the indexes created, or missing with dry_run
+    created = []
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information()
+        missing = [index for index in indexes
+                   if index.document['name'] not in existing]
+        for index in missing:
+            name = index.document['name']
+            if dry_run:
+                logger.info("[migrations] would create %s.%s",
+                            collection, name)
+                created.append('%s.%s' % (collection, name))
+                continue
+            try:
+                db[collection].create_indexes([index])
+            except OperationFailure as e:
+                # e.g. the same keys indexed under another name
+                logger.error("[migrations] unable to create %s.%s: %s",
+                             collection, name, e)
+                continue
+            logger.info("[migrations] created %s.%s", collection, name)
+            created.append('%s.%s' % (collection, name))
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=conf['log']['level'])
+    create_indexes(get_db(), args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,8 @@ t_dblp = db['dblp']  # type: pymongo.database.Collection
 t_arxiv = db['arxiv']  # type: pymongo.database.Collection
 t_records = db['records']  # type: pymongo.database.Collection
 t_authors = db['authors']  # type: pymongo.database.Collection
+t_users = db['users']  # type: pymongo.database.Collection
+t_neighbors = db['neighbors']  # type: pymongo.database.Collection
 
 r = redis.Redis(host=conf['redis']['host'],
                 port=conf['redis']['port'],
@@ -0,0 +1,241 @@
+# coding=utf-8
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import faiss
+import gensim
+
+from celery_workers.recommender import conf, logger, r
+from celery_workers.recommender.indexes import set_search_depth
+
+
+__all__ = ['Model', 'ModelHolder', 'model_holder', 'WV_FILENAME',
+           'INDEX_FILENAME', 'W2V_MODEL_FILENAME', 'new_version', 'create_staging', 'publish',
+           'current_version', 'get_version_path', 'read_manifest',
+           'attach', 'verify_once', 'load_model']
+
+
+# Layout of [artifacts] root:
+#   <version>/manifest.json   version, creation time, sha256 of every file
+#                             published
+#   <version>/<name>.sha256   sha256 of a file derived after the publication
+#   <version>/...             the artifacts themselves, never modified
+#   CURRENT                   name of the version in use, replaced atomically
+WV_FILENAME = 'word2vec.wv'
+INDEX_FILENAME = 'faiss.index'
+# the full word2vec model, only needed to keep training it
+W2V_MODEL_FILENAME = 'word2vec.model'
+MANIFEST_FILENAME = 'manifest.json'
+CHECKSUM_SUFFIX = '.sha256'
+CURRENT_FILENAME = 'CURRENT'
+# the current version, for the gateways (keep in sync with gateways/main.py)
+MODEL_VERSION_KEY = "recommender-model-version"
+
+
+class Model(NamedTuple):
+    version: str
+    wv: gensim.models.KeyedVectors
+    index: faiss.Index
+
+
+def get_root() -> str:
+    return conf['artifacts']['root']
+
+
+def new_version() -> str:
+    return time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+
+
+def create_staging(version: str) -> str:
+    path = os.path.join(get_root(), '.staging-' + version)
+    os.makedirs(path)
+    return path
+
+
+def sha256sum(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _fsync(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_atomically(path: str, content: str):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync(os.path.dirname(path))
+
+
+def publish(version: str, staging: str, extra: Optional[Dict] = None):
+    # seal the staging directory with a manifest, move it in place and only
+    # then point CURRENT at it, so readers never see a partial version
+    files = {}
+    for name in sorted(os.listdir(staging)):
+        path = os.path.join(staging, name)
+        _fsync(path)
+        files[name] = sha256sum(path)
+    manifest = {'version': version, 'created': time.time(), 'files': files}
+    manifest.update(extra or {})
+    _write_atomically(os.path.join(staging, MANIFEST_FILENAME),
+                      json.dumps(manifest, indent=2))
+
+    root = get_root()
+    os.rename(staging, os.path.join(root, version))
+    _fsync(root)
+    _write_atomically(os.path.join(root, CURRENT_FILENAME), version)
+    r.set(MODEL_VERSION_KEY, version)
+    # just hashed above
+    _verified_versions.add(version)
+    logger.info("[artifacts] version %s published", version)
+    prune()
+
+
+def prune():
+    root = get_root()
+    keep = int(conf['artifacts']['keep'])
+    current = current_version()
+    versions = sorted(name for name in os.listdir(root)
+                      if not name.startswith('.') and name != current
+                      and os.path.isdir(os.path.join(root, name)))
+    for version in versions[:max(0, len(versions) - keep + 1)]:
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+        logger.info("[artifacts] version %s pruned", version)
+
+
+def current_version() -> Optional[str]:
+    try:
+        with open(os.path.join(get_root(), CURRENT_FILENAME)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def get_version_path(version: str, filename: str = '') -> str:
+    return os.path.join(get_root(), version, filename)
+
+
+def read_manifest(version: str) -> Dict:
+    with open(get_version_path(version, MANIFEST_FILENAME)) as f:
+        return json.load(f)
+
+
+def attach(version: str, filename: str):
+    # a file computed after the publication (e.g. derived tables) gets a
+    # checksum file of its own: the derived tables are built concurrently,
+    # and the manifest is never rewritten
+    path = get_version_path(version, filename)
+    _fsync(path)
+    _write_atomically(path + CHECKSUM_SUFFIX, sha256sum(path))
+
+
+def get_checksums(version: str) -> Dict[str, str]:
+    # file name -> sha256, of the published and the attached files
+    checksums = dict(read_manifest(version)['files'])
+    for name in os.listdir(get_version_path(version)):
+        if name.endswith(CHECKSUM_SUFFIX):
+            with open(get_version_path(version, name)) as f:
+                checksums[name[:-len(CHECKSUM_SUFFIX)]] = f.read().strip()
+    return checksums
+
+
+def verify(version: str):
+    for name, checksum in get_checksums(version).items():
+        if sha256sum(get_version_path(version, name)) != checksum:
+            raise ValueError("Checksum mismatch of %s in version %s"
+                             % (name, version))
+
+
+# versions checked by this process, or by the main worker process before
+# forking it (see verify_once)
+_verified_versions = set()
+
+
+def verify_once(version: str):
+    # hashing every artifact takes long with large models, once per
+    # version is enough
+    if version in _verified_versions \
+            or not conf['artifacts'].getboolean('verify_checksums'):
+        return
+    verify(version)
+    _verified_versions.add(version)
+
+
+def read_index(path: str, mmap: bool) -> faiss.Index:
+    # index types without mmap support are read into memory
+    if mmap:
+        try:
+            return faiss.read_index(
+                path, faiss.IO_FLAG_MMAP
+                | getattr(faiss, 'IO_FLAG_READ_ONLY', 0))
+        except RuntimeError as e:
+            logger.warning("[artifacts] unable to mmap %s, reading it: %s",
+                           path, e)
+    return faiss.read_index(path)
+
+
+def load_model(version: str) -> Model:
+    # Memory mapped read only, the worker processes then share one copy
+    # in the page cache instead of holding one each.
+    verify_once(version)
+    mmap = conf['artifacts'].getboolean('mmap')
+    # noinspection PyTypeChecker
+    wv = gensim.models.KeyedVectors.load(
+        get_version_path(version, WV_FILENAME),
+        mmap='r' if mmap else None)  # type: gensim.models.KeyedVectors
+    index = read_index(get_version_path(version, INDEX_FILENAME), mmap)
+    set_search_depth(index)
+    return Model(version, wv, index)
+
+
+class ModelHolder:
+    # Every worker process checks CURRENT at most once per check_interval
+    # and swaps the whole Model at once. Tasks grab the Model once and
+    # keep using it, so a swap never affects a call in flight.
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.model = None  # type: Optional[Model]
+        self.last_check = 0.
+        self.on_swap = []  # type: List[Callable[[Model], None]]
+
+    def get(self) -> Optional[Model]:
+        if time.time() - self.last_check >= self.check_interval:
+            self.refresh()
+        return self.model
+
+    def refresh(self):
+        self.last_check = time.time()
+        version = current_version()
+        if version is None:
+            return
+        if self.model is not None and self.model.version == version:
+            return
+        try:
+            self.set(load_model(version))
+        except Exception:
+            logger.exception("[artifacts] unable to load version %s", version)
+
+    def set(self, model: Model):
+        self.model = model
+        logger.info("[artifacts] now serving version %s", model.version)
+        for callback in self.on_swap:
+            callback(model)
+
+
+model_holder = ModelHolder(float(conf['artifacts']['check_interval']))
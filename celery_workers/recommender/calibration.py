@@ -0,0 +1,145 @@
+# coding=utf-8
+import json
+import os
+import time
+from typing import Dict, List, Optional, Union
+
+import faiss
+import numpy as np
+
+from celery_workers.recommender import conf, logger
+from celery_workers.recommender.artifacts import Model, attach, \
+    get_version_path
+from celery_workers.recommender.indexes import get_depth_parameter, search
+
+
+__all__ = ['CALIBRATION_FILENAME', 'calibrate_search', 'build_calibration',
+           'parse_budget',
+           'choose_search_setting', 'SearchCalibrations',
+           'search_calibrations']
+
+
+# recall and latency of every (depth, k) setting, in the version directory
+CALIBRATION_FILENAME = 'calibration.json'
+
+
+def calibrate_search(index: faiss.Index, vectors: np.ndarray,
+                     depths: List[int], top_ks: List[int],
+                     n_queries: int, seed: int = 0) -> Dict:
+    # recall@k against an exact search, and the latency of one query
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(n_queries,
+                                                       len(vectors)),
+                                 replace=False)]
+    exact = faiss.IndexFlat(vectors.shape[1], index.metric_type)
+    exact.add(vectors)
+    _, expected = exact.search(queries, max(top_ks))
+
+    parameter = get_depth_parameter(index)
+    entries = []
+    for depth in (depths if parameter else [None]):
+        for top_k in top_ks:
+            latencies = []
+            found = []
+            for query in queries:
+                start = time.perf_counter()
+                _, indexes = search(index, query[np.newaxis], top_k, depth)
+                latencies.append(time.perf_counter() - start)
+                found.append(indexes[0])
+            recalls = [len(np.intersect1d(e[:top_k], f)) / top_k
+                       for e, f in zip(expected, found)]
+            entries.append({
+                'depth': depth,
+                'k': top_k,
+                'recall': float(np.mean(recalls)),
+                'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            })
+    return {'parameter': parameter, 'n_queries': len(queries),
+            'entries': entries}
+
+
+def build_calibration(model: Model) -> str:
+    section = conf['search_budget']
+    calibration = calibrate_search(
+        model.index, model.wv.get_normed_vectors(),
+        [int(i) for i in section['depths'].split(',')],
+        [int(i) for i in section['top_ks'].split(',')],
+        int(section['n_queries']))
+    path = get_version_path(model.version, CALIBRATION_FILENAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(path + '.tmp', path)
+    attach(model.version, CALIBRATION_FILENAME)
+    logger.info("[calibration] %d settings of version %s saved to %s",
+                len(calibration['entries']), model.version, path)
+    return path
+
+
+def parse_budget(budget: Union[None, str, Dict]) -> Dict[str, float]:
+    # a preset of [search_budget] or {'latency_ms': ..., 'recall': ...},
+    # either bound being optional
+    if budget is None:
+        budget = conf['search_budget']['default']
+    if isinstance(budget, str):
+        spec = conf['search_budget']['budget.' + budget]
+        budget = dict(item.split('=') for item in spec.split(',') if item)
+    return {key: float(value) for key, value in budget.items()
+            if key in ('latency_ms', 'recall')}
+
+
+def choose_search_setting(calibration: Dict,
+                          budget: Dict[str, float]) -> Dict:
+    # The cheapest setting meeting both bounds; past the latency bound, the
+    # best recall within it; when nothing is fast enough, the fastest one.
+    entries = calibration['entries']
+    max_latency = budget.get('latency_ms', float('inf'))
+    min_recall = budget.get('recall', 0.)
+    fast_enough = [e for e in entries if e['p99_ms'] <= max_latency]
+    good_enough = [e for e in fast_enough if e['recall'] >= min_recall]
+    if good_enough and 'recall' in budget:
+        return min(good_enough, key=lambda e: (e['p99_ms'], -e['k']))
+    if fast_enough:
+        return max(fast_enough, key=lambda e: (e['recall'], -e['p99_ms']))
+    return min(entries, key=lambda e: e['p99_ms'])
+
+
+class SearchCalibrations:
+    # the calibration table of the model version in use, a missing one
+    # (not built yet) is looked for again after check_interval
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.version = None  # type: Optional[str]
+        self.table = None  # type: Optional[Dict]
+        self.checked_at = 0.
+
+    def get(self, version: str) -> Optional[Dict]:
+        if version != self.version or self.table is None \
+                and time.time() - self.checked_at >= self.check_interval:
+            self.version, self.checked_at = version, time.time()
+            try:
+                with open(get_version_path(version,
+                                           CALIBRATION_FILENAME)) as f:
+                    self.table = json.load(f)
+            except FileNotFoundError:
+                self.table = None
+        return self.table
+
+    def get_setting(self, model: Model,
+                    budget: Union[None, str, Dict] = None) -> Dict:
+        # {'depth', 'k', ...}, the configured defaults when uncalibrated.
+        # k is never below search_top_k, the number of results.
+        top_k = int(conf['faiss']['search_top_k'])
+        calibration = self.get(model.version)
+        entries = [entry for entry in (calibration or {}).get('entries', [])
+                   if entry['k'] >= top_k]
+        if not entries:
+            return {'depth': None, 'k': top_k, 'calibrated': False}
+        setting = choose_search_setting(dict(calibration, entries=entries),
+                                        parse_budget(budget))
+        return dict(setting, parameter=calibration['parameter'],
+                    calibrated=True)
+
+
+search_calibrations = SearchCalibrations(
+    float(conf['artifacts']['check_interval']))
@@ -0,0 +1,158 @@
+# coding=utf-8
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from sklearn.cluster import DBSCAN, KMeans, MiniBatchKMeans
+
+from celery_workers.recommender import conf
+
+
+__all__ = ['cap_vectors', 'dbscan_centers', 'minibatch_kmeans_centers',
+           'ALGORITHMS', 'reduce_centers', 'cluster_interest_vectors',
+           'get_merge_radius', 'merge_nearest_centers', 'compare_with_dbscan']
+
+
+def cap_vectors(vectors: np.ndarray, max_samples: int,
+                recent_share: float,
+                rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    # Vectors are ordered from the oldest interest to the most recent one.
+    # Keeps the most recent `recent_share` of the budget as is and samples
+    # the rest uniformly among the older ones.
+    if len(vectors) <= max_samples:
+        return vectors
+    rng = rng or np.random.default_rng()
+    n_recent = int(max_samples * recent_share)
+    n_older = len(vectors) - n_recent
+    sampled = np.sort(rng.choice(n_older, size=max_samples - n_recent,
+                                 replace=False))
+    return np.concatenate([vectors[sampled], vectors[n_older:]])
+
+
+def _centers_of(vectors: np.ndarray,
+                labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    centers = []
+    counts = []
+    for label in set(labels):
+        if label == -1:
+            continue
+        class_member_mask = (labels == label)
+        centers.append(np.average(vectors[class_member_mask], axis=0))
+        counts.append(np.count_nonzero(class_member_mask))
+    return np.array(centers), np.array(counts, dtype=np.int32)
+
+
+def dbscan_centers(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    clustering = DBSCAN(eps=float(conf['dbscan']['eps']),
+                        min_samples=int(conf['dbscan']['min_samples'])
+                        ).fit(vectors)
+    return _centers_of(vectors, clustering.labels_)
+
+
+def minibatch_kmeans_centers(vectors: np.ndarray) -> Tuple[np.ndarray,
+                                                           np.ndarray]:
+    # as many clusters as DBSCAN could find at most, within max_clusters
+    n_clusters = min(int(conf['clustering']['max_clusters']),
+                     max(1, len(vectors) // int(conf['dbscan']['min_samples'])))
+    clustering = MiniBatchKMeans(
+        n_clusters=n_clusters,
+        batch_size=int(conf['clustering']['kmeans_batch_size']),
+        max_iter=int(conf['clustering']['kmeans_max_iter']),
+        n_init=1, random_state=0).fit(vectors)
+    return _centers_of(vectors, clustering.labels_)
+
+
+ALGORITHMS = {
+    'dbscan': dbscan_centers,
+    'minibatch_kmeans': minibatch_kmeans_centers,
+}
+
+
+def reduce_centers(centers: np.ndarray, counts: np.ndarray,
+                   max_clusters: int) -> Tuple[np.ndarray, np.ndarray]:
+    # at most max_clusters centers, a k-means of the centers weighted by
+    # their number of members
+    if len(centers) <= max_clusters:
+        return centers, counts
+    clustering = KMeans(n_clusters=max_clusters, n_init=1, random_state=0
+                        ).fit(centers, sample_weight=counts)
+    reduced_counts = np.bincount(clustering.labels_, weights=counts,
+                                 minlength=max_clusters)
+    kept = reduced_counts > 0
+    return clustering.cluster_centers_[kept].astype(centers.dtype), \
+        reduced_counts[kept].astype(np.int32)
+
+
+def cluster_interest_vectors(vectors: np.ndarray,
+                             algorithm: Optional[str] = None,
+                             max_samples: Optional[int] = None,
+                             max_clusters: Optional[int] = None,
+                             rng: Optional[np.random.Generator] = None
+                             ) -> Tuple[np.ndarray, np.ndarray]:
+    # returns the cluster centers along with the number of members of each,
+    # max_samples and max_clusters default to [clustering] (0: no limit)
+    if len(vectors) == 0:
+        return vectors, np.empty((0,), dtype=np.int32)
+
+    algorithm = algorithm or conf['clustering']['algorithm']
+    if max_samples is None:
+        max_samples = int(conf['clustering']['max_samples'])
+    if max_clusters is None:
+        max_clusters = int(conf['clustering']['max_clusters'])
+    if max_samples > 0:
+        vectors = cap_vectors(vectors, max_samples,
+                              float(conf['clustering']['recent_share']), rng)
+    centers, counts = ALGORITHMS[algorithm](vectors)
+    if len(centers) <= 2:
+        # no structure found, the vectors themselves
+        centers, counts = vectors, np.ones((len(vectors),), dtype=np.int32)
+    if max_clusters > 0:
+        centers, counts = reduce_centers(centers, counts, max_clusters)
+    return centers, counts
+
+
+def get_merge_radius(algorithm: Optional[str] = None) -> float:
+    # distance within which a new interest joins an existing center
+    algorithm = algorithm or conf['clustering']['algorithm']
+    if algorithm == 'dbscan':
+        return float(conf['dbscan']['eps'])
+    return float(conf['clustering']['kmeans_merge_radius'])
+
+
+def merge_nearest_centers(centers: np.ndarray, counts: np.ndarray
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+    # the two closest centers become their weighted average; the squared
+    # distances come from the Gram matrix, (n, n) rather than (n, n, dim)
+    squared_norms = np.einsum('ij,ij->i', centers, centers)
+    distances = squared_norms[:, np.newaxis] + squared_norms[np.newaxis] \
+        - 2 * centers @ centers.T
+    np.fill_diagonal(distances, np.inf)
+    i, j = np.unravel_index(distances.argmin(), distances.shape)
+    centers[i] = (centers[i] * counts[i] + centers[j] * counts[j]) \
+        / (counts[i] + counts[j])
+    counts[i] += counts[j]
+    return np.delete(centers, j, axis=0), np.delete(counts, j)
+
+
+def compare_with_dbscan(vectors: np.ndarray,
+                        rng: Optional[np.random.Generator] = None) -> Dict:
+    # cosine similarity between the profile vector of the configured,
+    # bounded clustering and the one of an uncapped DBSCAN
+    start = time.perf_counter()
+    expected, _ = cluster_interest_vectors(vectors, 'dbscan', max_samples=0,
+                                           max_clusters=0)
+    dbscan_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual, _ = cluster_interest_vectors(vectors, rng=rng)
+    seconds = time.perf_counter() - start
+
+    expected = expected.mean(axis=0)
+    actual = actual.mean(axis=0)
+    return {
+        'n_vectors': len(vectors),
+        'similarity': float(np.dot(expected, actual)
+                            / (np.linalg.norm(expected)
+                               * np.linalg.norm(actual))),
+        'dbscan_seconds': dbscan_seconds,
+        'seconds': seconds,
+    }
@@ -0,0 +1,101 @@
+# coding=utf-8
+import datetime
+import json
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+import pymongo
+
+from celery_workers.recommender import conf, logger, t_records
+
+
+__all__ = ['CORPUS_QUERY', 'CORPUS_PROJECTION', 'LAST_INGESTED_SORT',
+           'corpus_filter', 'ingested_since', 'make_sentence',
+           'export_corpus']
+
+
+# Computer Science records having at least 4 citations to sample from:
+# outCitations when there are any, inCitations otherwise
+CORPUS_QUERY = {
+    'fieldsOfStudy': 'Computer Science',
+    '$or': [
+        {'outCitations.3': {'$exists': True}},
+        {'outCitations.0': {'$exists': False},
+         'inCitations.3': {'$exists': True}},
+    ],
+}
+CORPUS_PROJECTION = {'outCitations': 1, 'inCitations': 1}
+# the last ingested record comes first (the ingestedAt index); shared with
+# tests/test_query_plans.py, like the filters below
+LAST_INGESTED_SORT = [('ingestedAt', pymongo.DESCENDING)]
+
+
+def corpus_filter(query: Optional[Dict] = None) -> Dict:
+    return dict(CORPUS_QUERY, **(query or {}))
+
+
+def ingested_since(since: datetime.datetime) -> Dict:
+    return {'ingestedAt': {'$gt': since}}
+
+
+def make_sentence(record: Dict, rng: random.Random) -> List[str]:
+    raw_words = record.get('outCitations') or record.get('inCitations')
+    raw_words = rng.sample(raw_words, k=4)
+    raw_words.append(record['_id'])
+    rng.shuffle(raw_words)
+    return raw_words
+
+
+def get_records_fingerprint() -> Dict:
+    # cheap enough to be checked before every training
+    last = t_records.find_one({}, {'ingestedAt': 1},
+                              sort=LAST_INGESTED_SORT)
+    return {
+        'count': t_records.estimated_document_count(),
+        'last_ingested': last.get('ingestedAt').isoformat()
+        if last and last.get('ingestedAt') else None,
+    }
+
+
+def export_corpus(name: str, seed: int, query: Optional[Dict] = None) -> str:
+    # Streams the sentences into a LineSentence file (space separated ids,
+    # one sentence per line) usable as word2vec's `corpus_file`. The file is
+    # reused as long as the seed, the query and the records are the same.
+    path = os.path.join(conf['corpus']['dir'], name + '.txt')
+    meta_path = path + '.meta.json'
+    meta = {
+        'seed': seed,
+        'query': json.dumps(query or {}, sort_keys=True, default=str),
+        'records': get_records_fingerprint(),
+    }
+    try:
+        with open(meta_path) as f:
+            if json.load(f) == meta and os.path.exists(path):
+                logger.debug("[corpus] Reusing %s", path)
+                return path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(conf['corpus']['dir'], exist_ok=True)
+    rng = random.Random(seed)
+    cursor = t_records.find(corpus_filter(query), CORPUS_PROJECTION,
+                            batch_size=int(conf['corpus']['batch_size']))
+    n = 0
+    last_time = time.time()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for record in cursor:
+            f.write(' '.join(make_sentence(record, rng)))
+            f.write('\n')
+            n += 1
+            if n % 100000 == 0:
+                logger.debug("[corpus] Exported 100000 records within %.2f s",
+                             time.time() - last_time)
+                last_time = time.time()
+    os.replace(tmp_path, path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    logger.info("[corpus] %d sentences exported to %s", n, path)
+    return path
@@ -0,0 +1,233 @@
+# coding=utf-8
+import array
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse
+
+from celery_workers.recommender import conf, logger, t_records
+from celery_workers.recommender.artifacts import Model, attach, \
+    get_version_path
+
+
+__all__ = ['GRAPH_INDPTR_FILENAME', 'GRAPH_INDICES_FILENAME',
+           'GRAPH_KEYS_FILENAME', 'CitationGraph', 'build_citation_graph',
+           'CitationGraphs', 'citation_graphs']
+
+
+# Undirected citation graph of a model version, in CSR form. Nodes are the
+# word indexes of wv.index_to_key, then the papers without an embedding,
+# whose sorted ids (bytes) are in GRAPH_KEYS_FILENAME.
+GRAPH_INDPTR_FILENAME = 'graph-indptr.npy'
+GRAPH_INDICES_FILENAME = 'graph-indices.npy'
+GRAPH_KEYS_FILENAME = 'graph-keys.npy'
+
+
+class CitationGraph:
+    def __init__(self, model: Model, indptr: np.ndarray,
+                 indices: np.ndarray, extra_keys: np.ndarray):
+        self.wv = model.wv
+        self.indptr = indptr
+        self.indices = indices
+        self.extra_keys = extra_keys
+        self.n_nodes = len(indptr) - 1
+
+    @classmethod
+    def load(cls, model: Model) -> 'CitationGraph':
+        # memory mapped, shared by the worker processes through the page
+        # cache
+        return cls(model, *(
+            np.load(get_version_path(model.version, filename), mmap_mode='r')
+            for filename in (GRAPH_INDPTR_FILENAME, GRAPH_INDICES_FILENAME,
+                             GRAPH_KEYS_FILENAME)))
+
+    def node_of(self, key: Optional[str]) -> Optional[int]:
+        # None for the keys /recommend/batch couldn't resolve
+        if key is None:
+            return None
+        index = self.wv.key_to_index.get(key)
+        if index is not None:
+            return index
+        key = key.encode()
+        position = int(np.searchsorted(self.extra_keys, key))
+        if position < len(self.extra_keys) \
+                and self.extra_keys[position] == key:
+            return len(self.wv) + position
+        return None
+
+    def key_of(self, node: int) -> str:
+        if node < len(self.wv):
+            return self.wv.index_to_key[node]
+        return self.extra_keys[node - len(self.wv)].decode()
+
+    def degrees(self, nodes: np.ndarray) -> np.ndarray:
+        return self.indptr[nodes + 1] - self.indptr[nodes]
+
+    def edges(self, nodes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (source, target) of every edge leaving `nodes`, without a python
+        # loop over the nodes
+        starts = self.indptr[nodes]
+        counts = self.indptr[nodes + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) \
+            + np.arange(counts.sum())
+        return np.repeat(nodes, counts), np.asarray(self.indices[offsets])
+
+    def neighbors(self, nodes: np.ndarray) -> np.ndarray:
+        return np.unique(self.edges(nodes)[1])
+
+    def expand(self, seeds: np.ndarray, hops: int,
+               max_nodes: int) -> np.ndarray:
+        # sorted nodes within `hops` of the seeds, the expansion stops at
+        # the hop exceeding max_nodes
+        nodes = np.unique(seeds)
+        frontier = nodes
+        for _ in range(hops):
+            reached = np.setdiff1d(self.neighbors(frontier), nodes,
+                                   assume_unique=True)
+            if len(reached) == 0 or len(nodes) + len(reached) > max_nodes:
+                break
+            nodes = np.union1d(nodes, reached)
+            frontier = reached
+        return nodes
+
+    def personalized_pagerank(self, seeds: np.ndarray,
+                              alpha: float = None, iterations: int = None,
+                              tolerance: float = None, hops: int = None,
+                              max_nodes: int = None
+                              ) -> Tuple[np.ndarray, np.ndarray]:
+        # Power iteration on the neighborhood of the seeds, walks leaving it
+        # are lost. Returns (nodes, scores).
+        section = conf['graph']
+        alpha = alpha or float(section['alpha'])
+        iterations = iterations or int(section['iterations'])
+        tolerance = tolerance or float(section['tolerance'])
+        nodes = self.expand(seeds, hops or int(section['hops']),
+                            max_nodes or int(section['max_nodes']))
+
+        sources, targets = self.edges(nodes)
+        positions = np.searchsorted(nodes, targets)
+        positions[positions == len(nodes)] = 0
+        inside = nodes[positions] == targets
+        sources = np.searchsorted(nodes, sources[inside])
+        weights = 1. / np.maximum(self.degrees(nodes), 1)[sources]
+        # transition[target, source] = 1 / degree(source)
+        transition = scipy.sparse.csr_matrix(
+            (weights, (positions[inside], sources)),
+            shape=(len(nodes), len(nodes)))
+
+        restart = np.zeros(len(nodes))
+        restart[np.searchsorted(nodes, np.unique(seeds))] = 1.
+        restart /= restart.sum()
+        scores = restart
+        for _ in range(iterations):
+            previous = scores
+            scores = alpha * restart + (1 - alpha) * (transition @ scores)
+            if np.abs(scores - previous).sum() < tolerance:
+                break
+        return nodes, scores
+
+    def recommend(self, paper_id: str, top_k: int) -> Optional[List[str]]:
+        # for papers without an embedding
+        node = self.node_of(paper_id)
+        if node is None:
+            return None
+        nodes, scores = self.personalized_pagerank(np.array([node]))
+        order = np.argsort(-scores)
+        return [self.key_of(i) for i in nodes[order[:top_k + 1]]
+                if i != node][:top_k]
+
+    def rerank(self, paper_id: str, paper_ids: List[str],
+               weight: float) -> List[str]:
+        # blends the rank of the candidates with their PageRank around the
+        # seed, both scaled to [0, 1]
+        node = self.node_of(paper_id)
+        if node is None or not paper_ids:
+            return paper_ids
+        nodes, scores = self.personalized_pagerank(np.array([node]))
+        candidates = np.array([self.node_of(i) for i in paper_ids])
+        positions = np.minimum(np.searchsorted(nodes, candidates),
+                               len(nodes) - 1)
+        graph_scores = np.where(nodes[positions] == candidates,
+                                scores[positions], 0.)
+        if graph_scores.max() > 0:
+            graph_scores /= graph_scores.max()
+        rank_scores = 1 - np.arange(len(paper_ids)) / len(paper_ids)
+        order = np.argsort(-((1 - weight) * rank_scores
+                             + weight * graph_scores), kind='stable')
+        return [paper_ids[i] for i in order]
+
+
+def _save(version: str, filename: str, arr: np.ndarray):
+    path = get_version_path(version, filename)
+    np.save(path + '.tmp.npy', arr)
+    os.replace(path + '.tmp.npy', path)
+    attach(version, filename)
+
+
+def build_citation_graph(model: Model) -> CitationGraph:
+    wv = model.wv
+    start_time = time.time()
+    extra_keys = sorted(record['_id'] for record in
+                        t_records.find({}, {'_id': 1})
+                        if record['_id'] not in wv.key_to_index)
+    extra = {key: len(wv) + i for i, key in enumerate(extra_keys)}
+    n_nodes = len(wv) + len(extra_keys)
+
+    sources, targets = array.array('i'), array.array('i')
+    for record in t_records.find({}, {'outCitations': 1}):
+        source = wv.key_to_index.get(record['_id'], extra.get(record['_id']))
+        if source is None:
+            # ingested after the first pass, in the next graph
+            continue
+        for cited in record.get('outCitations') or []:
+            target = wv.key_to_index.get(cited, extra.get(cited))
+            # citations of papers out of the database are dropped
+            if target is not None and target != source:
+                sources.append(source)
+                targets.append(target)
+    del extra
+    sources = np.frombuffer(sources, dtype=np.int32)
+    targets = np.frombuffer(targets, dtype=np.int32)
+    # both directions, duplicated citations are merged
+    adjacency = scipy.sparse.csr_matrix(
+        (np.ones(2 * len(sources), dtype=np.int8),
+         (np.concatenate([sources, targets]),
+          np.concatenate([targets, sources]))),
+        shape=(n_nodes, n_nodes))
+    adjacency.sum_duplicates()
+
+    _save(model.version, GRAPH_INDPTR_FILENAME,
+          adjacency.indptr.astype(np.int64))
+    _save(model.version, GRAPH_INDICES_FILENAME,
+          adjacency.indices.astype(np.int32))
+    _save(model.version, GRAPH_KEYS_FILENAME,
+          np.array([key.encode() for key in extra_keys], dtype=bytes))
+    logger.info("[graph] %d nodes (%d without embedding), %d edges of "
+                "version %s built within %.2f s", n_nodes, len(extra_keys),
+                adjacency.nnz // 2, model.version, time.time() - start_time)
+    return CitationGraph.load(model)
+
+
+class CitationGraphs:
+    # the graph of the model version in use, a missing one (not built yet)
+    # is looked for again after check_interval
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.version = None  # type: Optional[str]
+        self.graph = None  # type: Optional[CitationGraph]
+        self.checked_at = 0.
+
+    def get(self, model: Model) -> Optional[CitationGraph]:
+        if model.version != self.version or self.graph is None \
+                and time.time() - self.checked_at >= self.check_interval:
+            self.version, self.checked_at = model.version, time.time()
+            try:
+                self.graph = CitationGraph.load(model)
+            except FileNotFoundError:
+                self.graph = None
+        return self.graph
+
+
+citation_graphs = CitationGraphs(float(conf['artifacts']['check_interval']))
@@ -0,0 +1,164 @@
+# coding=utf-8
+import time
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from celery_workers.recommender import conf, logger
+
+
+__all__ = ['INDEX_TYPES', 'METRICS', 'get_factory_string', 'build_index',
+           'set_search_depth', 'get_depth_parameter', 'search',
+           'to_distances', 'evaluate_index', 'evaluate_index_types']
+
+
+METRICS = {
+    'l2': faiss.METRIC_L2,
+    'ip': faiss.METRIC_INNER_PRODUCT,
+}
+
+# name -> faiss.index_factory description, formatted with the [faiss] section
+INDEX_TYPES = {
+    'Flat': "Flat",
+    'IVFFlat': "IVF{nlist},Flat",
+    'IVFPQ': "IVF{nlist},PQ{pq_m}",
+    'OPQ': "OPQ{pq_m},IVF{nlist},PQ{pq_m}",
+    'HNSW': "HNSW{hnsw_m}",
+}
+
+
+def get_factory_string(index_type: str, section=None) -> str:
+    section = section or conf['faiss']
+    return INDEX_TYPES[index_type].format(**section)
+
+
+def build_index(vectors: np.ndarray, index_type: Optional[str] = None,
+                metric: Optional[str] = None) -> faiss.Index:
+    index_type = index_type or conf['faiss']['index_type']
+    metric = metric or conf['faiss']['metric']
+    index = faiss.index_factory(int(conf['faiss']['dimension']),
+                                get_factory_string(index_type),
+                                METRICS[metric])
+    if not index.is_trained:
+        index.train(vectors)
+        logger.debug("Faiss index %s trained", index_type)
+    index.add(vectors)
+    set_search_depth(index)
+    return index
+
+
+def set_search_depth(index: faiss.Index, nprobe: Optional[int] = None,
+                     ef_search: Optional[int] = None):
+    # ParameterSpace reaches through the OPQ/IVF wrappers; parameters that
+    # don't apply to the index type are skipped
+    params = faiss.ParameterSpace()
+    index_ivf = faiss.try_extract_index_ivf(index)
+    if index_ivf is not None:
+        params.set_index_parameter(
+            index, 'nprobe', nprobe or int(conf['faiss']['nprobe']))
+    if 'HNSW' in type(faiss.downcast_index(index)).__name__:
+        params.set_index_parameter(
+            index, 'efSearch', ef_search or int(conf['faiss']['ef_search']))
+
+
+def get_depth_parameter(index: faiss.Index) -> Optional[str]:
+    # the knob trading recall for latency, None for exact indexes
+    if faiss.try_extract_index_ivf(index) is not None:
+        return 'nprobe'
+    if 'HNSW' in type(faiss.downcast_index(index)).__name__:
+        return 'efSearch'
+    return None
+
+
+def _get_search_parameters(index: faiss.Index, depth: int):
+    # per call parameters (faiss >= 1.7.3), None when not supported
+    if not hasattr(faiss, 'SearchParametersIVF'):
+        return None
+    wrappers = 0
+    inner = faiss.downcast_index(index)
+    while isinstance(inner, faiss.IndexPreTransform):
+        wrappers += 1
+        inner = faiss.downcast_index(inner.index)
+    parameter = get_depth_parameter(inner)
+    if parameter == 'nprobe':
+        params = faiss.SearchParametersIVF(nprobe=depth)
+    elif parameter == 'efSearch':
+        params = faiss.SearchParametersHNSW(efSearch=depth)
+    else:
+        return None
+    for _ in range(wrappers):
+        params = faiss.SearchParametersPreTransform(index_params=params)
+    return params
+
+
+def search(index: faiss.Index, queries: np.ndarray, top_k: int,
+           depth: Optional[int] = None):
+    # `depth` is the nprobe or efSearch of this search only, the one set by
+    # set_search_depth otherwise
+    if depth is None or get_depth_parameter(index) is None:
+        return index.search(queries, top_k)
+    params = _get_search_parameters(index, depth)
+    if params is not None:
+        return index.search(queries, top_k, params=params)
+    # older faiss: set it on the index for this call, worker processes
+    # search one request at a time
+    set_search_depth(index, nprobe=depth, ef_search=depth)
+    try:
+        return index.search(queries, top_k)
+    finally:
+        set_search_depth(index)
+
+
+def to_distances(index: faiss.Index, scores: np.ndarray) -> np.ndarray:
+    # inner products of normalized vectors are similarities, turn them into
+    # (cosine) distances so that "smaller is closer" holds for every metric
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return 1 - scores
+    return scores
+
+
+def evaluate_index(index: faiss.Index, vectors: np.ndarray,
+                   queries: np.ndarray, top_k: int) -> Dict:
+    exact = faiss.IndexFlat(vectors.shape[1], index.metric_type)
+    exact.add(vectors)
+    _, expected = exact.search(queries, top_k)
+
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, indexes = index.search(query[np.newaxis], top_k)
+        latencies.append(time.perf_counter() - start)
+        found.append(indexes[0])
+
+    recalls = [len(np.intersect1d(e, f)) / top_k
+               for e, f in zip(expected, found)]
+    return {
+        'recall': float(np.mean(recalls)),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'memory_bytes': int(faiss.serialize_index(index).nbytes),
+    }
+
+
+def evaluate_index_types(vectors: np.ndarray,
+                         index_types: List[str], metrics: List[str],
+                         n_queries: int, top_k: int,
+                         seed: int = 0) -> List[Dict]:
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=n_queries,
+                                 replace=False)]
+    results = []
+    for metric in metrics:
+        for index_type in index_types:
+            start = time.time()
+            index = build_index(vectors, index_type, metric)
+            result = evaluate_index(index, vectors, queries, top_k)
+            result.update(index_type=index_type, metric=metric,
+                          factory=get_factory_string(index_type),
+                          build_seconds=time.time() - start)
+            logger.info("[faiss eval] %s", result)
+            results.append(result)
+    return results
+
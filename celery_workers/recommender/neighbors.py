@@ -0,0 +1,57 @@
+# coding=utf-8
+import time
+
+import numpy as np
+from pymongo import ReplaceOne
+
+from celery_workers.recommender import conf, logger, t_neighbors
+from celery_workers.recommender.artifacts import Model
+from celery_workers.recommender.ranking import gather_normed_vectors
+
+
+__all__ = ['build_neighbor_table']
+
+
+def _drop_self(indexes: np.ndarray, self_indexes: np.ndarray) -> np.ndarray:
+    # `indexes` has top_k + 1 columns, drop the vector itself (or the last
+    # neighbor when the vector isn't among its own results)
+    top_k = indexes.shape[1] - 1
+    is_self = indexes == self_indexes[:, np.newaxis]
+    is_self[~is_self.any(axis=1), -1] = True
+    is_self &= np.cumsum(is_self, axis=1) == 1
+    return indexes[~is_self].reshape(len(indexes), top_k)
+
+
+def build_neighbor_table(model: Model, top_k: int = None,
+                         batch_size: int = None) -> int:
+    # The nearest neighbors of every vector of the model, written to the
+    # neighbors collection ({_id, model_version, paper_ids}) that the
+    # gateways serve anonymous recommendations from. Returns the number of
+    # papers written.
+    top_k = top_k or int(conf['neighbors']['top_k'])
+    batch_size = batch_size or int(conf['neighbors']['batch_size'])
+
+    wv, index = model.wv, model.index
+    last_time = time.time()
+    for start in range(0, len(wv), batch_size):
+        self_indexes = np.arange(start, min(start + batch_size, len(wv)))
+        vectors = gather_normed_vectors(wv, self_indexes).astype(np.float32)
+        _, indexes = index.search(vectors, top_k + 1)
+        indexes = _drop_self(indexes, self_indexes)
+        t_neighbors.bulk_write([
+            ReplaceOne({'_id': wv.index_to_key[i]},
+                       {'_id': wv.index_to_key[i],
+                        'model_version': model.version,
+                        'paper_ids': [wv.index_to_key[j]
+                                      for j in row if j >= 0]},
+                       upsert=True)
+            for i, row in zip(self_indexes, indexes)
+        ], ordered=False)
+        if (start // batch_size) % 100 == 99:
+            logger.debug("[neighbors] %d/%d vectors within %.2f s",
+                         start + len(indexes), len(wv),
+                         time.time() - last_time)
+            last_time = time.time()
+    logger.info("[neighbors] table of version %s written, %d papers",
+                model.version, len(wv))
+    return len(wv)
@@ -0,0 +1,220 @@
+# coding=utf-8
+from collections import OrderedDict
+from typing import List, Optional, Iterable
+
+import gensim
+import numpy as np
+from bson import ObjectId
+
+from celery_workers.metrics import CACHE_LOOKUPS, RECOMMEND_STAGE_SECONDS
+from celery_workers.recommender import conf, logger, r, \
+    t_authors, t_records, t_users
+from celery_workers.recommender.clustering import \
+    cluster_interest_vectors, get_merge_radius, merge_nearest_centers, \
+    reduce_centers
+
+
+__all__ = ['AuthorProfileCache', 'author_profile_cache',
+           'lookup_normed_vectors', 'fetch_author_interest_paper_ids',
+           'get_author_interest_vectors', 'ProfileStore', 'profile_store']
+
+
+# author_id -> interest vectors, must be cleared once a new model is loaded
+class AuthorProfileCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, author_id) -> Optional[np.ndarray]:
+        try:
+            self.data.move_to_end(author_id)
+        except KeyError:
+            CACHE_LOOKUPS.labels('author_profile', 'miss').inc()
+            return None
+        CACHE_LOOKUPS.labels('author_profile', 'hit').inc()
+        return self.data[author_id]
+
+    def put(self, author_id, vectors: np.ndarray):
+        if self.maxsize <= 0:
+            return
+        self.data[author_id] = vectors
+        self.data.move_to_end(author_id)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+
+author_profile_cache = AuthorProfileCache(
+    int(conf['profile']['author_cache_size']))
+
+
+def lookup_normed_vectors(wv: gensim.models.KeyedVectors,
+                          keys: Iterable[str]) -> np.ndarray:
+    # keys out of the vocabulary are silently skipped
+    indexes = [wv.key_to_index[key] for key in keys if key in wv.key_to_index]
+    if not indexes:
+        return np.empty((0, wv.vector_size), dtype=np.float32)
+    wv.fill_norms()
+    indexes = np.array(indexes)
+    return wv.vectors[indexes] / wv.norms[indexes, np.newaxis]
+
+
+def fetch_author_interest_paper_ids(wv: gensim.models.KeyedVectors,
+                                    author_id) -> List[str]:
+    author = t_authors.find_one({'_id': author_id}, {'papers': 1})
+    if author is None:
+        logger.error("Unable to find author with _id=%s", author_id)
+        return []
+    paper_ids = author['papers']
+
+    records = {
+        record['_id']: record.get('outCitations') or []
+        for record in t_records.find({'_id': {'$in': paper_ids}},
+                                     {'_id': 1, 'outCitations': 1})
+    }
+
+    interest_paper_ids = []
+    for paper_id in paper_ids:
+        if paper_id not in records:
+            logger.error("Unable to find paper with _id=%s", paper_id)
+            continue
+        # papers without an embedding are skipped along with their citations
+        if paper_id not in wv.key_to_index:
+            continue
+        interest_paper_ids.append(paper_id)
+        interest_paper_ids.extend(records[paper_id])
+    return interest_paper_ids
+
+
+def get_author_interest_vectors(wv: gensim.models.KeyedVectors,
+                                author_id) -> np.ndarray:
+    vectors = author_profile_cache.get(author_id)
+    if vectors is None:
+        vectors = lookup_normed_vectors(
+            wv, fetch_author_interest_paper_ids(wv, author_id))
+        author_profile_cache.put(author_id, vectors)
+    return vectors
+
+
+class ProfileStore:
+    # Per (model version, user) profile kept in a redis hash:
+    #   centers: float32 (n, dim), counts: int32 (n,), profile: float32 (dim,)
+    KEY_FORMAT = "profile-%s-%s"
+    # keep in sync with gateways/users.py
+    VISITED_KEY_FORMAT = "visited-%s"
+    REVISION_KEY_FORMAT = "visited-revision-%s"
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    def key(self, model_version: str, user_id: str) -> str:
+        return self.KEY_FORMAT % (model_version, user_id)
+
+    def get_profile_vector(self, model_version: str,
+                           user_id: str) -> Optional[np.ndarray]:
+        value = r.hget(self.key(model_version, user_id), 'profile')
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32).reshape(1, -1)
+
+    def save(self, model_version: str, user_id: str,
+             centers: np.ndarray, counts: np.ndarray, pipe=None):
+        key = self.key(model_version, user_id)
+        pipe = pipe or r.pipeline()
+        pipe.hset(key, mapping={
+            'centers': centers.astype(np.float32).tobytes(),
+            'counts': counts.astype(np.int32).tobytes(),
+            'profile': centers.mean(axis=0).astype(np.float32).tobytes(),
+        })
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def build(self, wv: gensim.models.KeyedVectors, model_version: str,
+              user_id: str) -> Optional[np.ndarray]:
+        with RECOMMEND_STAGE_SECONDS.labels('profile_fetch').time():
+            # the gateway keeps the recent visits in redis, the user
+            # document may lag behind them
+            visited = [record_id.decode() for record_id in
+                       r.zrange(self.VISITED_KEY_FORMAT % user_id, 0, -1)]
+            projection = {'author_id': 1}
+            if not visited:
+                projection['visited'] = 1
+            user = t_users.find_one({'_id': ObjectId(user_id)}, projection)
+            if user is None:
+                logger.error("Unable to find user with _id=%s", user_id)
+                return None
+            visited = visited or user.get('visited') or []
+
+            # from the oldest interests to the most recent ones
+            vectors = lookup_normed_vectors(wv, visited)
+            if user.get('author_id'):
+                vectors = np.concatenate([
+                    get_author_interest_vectors(wv, user['author_id']),
+                    vectors])
+        with RECOMMEND_STAGE_SECONDS.labels('clustering').time():
+            centers, counts = cluster_interest_vectors(vectors)
+        if len(centers) == 0:
+            return None
+        self.save(model_version, user_id, centers, counts)
+        return centers.mean(axis=0, keepdims=True).astype(np.float32)
+
+    def get_or_build(self, wv: gensim.models.KeyedVectors, model_version: str,
+                     user_id: str) -> Optional[np.ndarray]:
+        with RECOMMEND_STAGE_SECONDS.labels('profile_fetch').time():
+            vector = self.get_profile_vector(model_version, user_id)
+        if vector is None:
+            vector = self.build(wv, model_version, user_id)
+        return vector
+
+    def add_visit(self, wv: gensim.models.KeyedVectors, model_version: str,
+                  user_id: str, paper_id: str):
+        vectors = lookup_normed_vectors(wv, [paper_id])
+        if len(vectors) == 0:
+            return
+        vector = vectors[0]
+        key = self.key(model_version, user_id)
+        radius = get_merge_radius()
+        max_clusters = int(conf['clustering']['max_clusters'])
+
+        def update(pipe):
+            centers, counts = pipe.hmget(key, 'centers', 'counts')
+            if centers is None:
+                # not built yet, the visit is picked up by the next build
+                return
+            centers = np.frombuffer(centers, dtype=np.float32) \
+                .reshape(-1, len(vector)).copy()
+            counts = np.frombuffer(counts, dtype=np.int32).copy()
+            distances = np.linalg.norm(centers - vector, axis=1)
+            nearest = int(distances.argmin())
+            if distances[nearest] <= radius:
+                centers[nearest] = (centers[nearest] * counts[nearest]
+                                    + vector) / (counts[nearest] + 1)
+                counts[nearest] += 1
+            else:
+                centers = np.vstack([centers, vector])
+                counts = np.append(counts, 1)
+                # the centers aren't ordered by age, the two closest ones
+                # are merged to stay within the cluster budget
+                if len(centers) > max_clusters + 1:
+                    # saved before builds were bounded by max_clusters
+                    centers, counts = reduce_centers(centers, counts,
+                                                     max_clusters)
+                elif len(centers) > max_clusters:
+                    centers, counts = merge_nearest_centers(centers, counts)
+            pipe.multi()
+            self.save(model_version, user_id, centers, counts, pipe=pipe)
+
+        r.transaction(update, key)
+
+    def bump_revision(self, user_id: str):
+        # read by the gateways into the ids of the recommendation results,
+        # once the visits are in the profile (see task_update_profile)
+        pipe = r.pipeline()
+        pipe.incr(self.REVISION_KEY_FORMAT % user_id)
+        pipe.expire(self.REVISION_KEY_FORMAT % user_id, self.ttl)
+        pipe.execute()
+
+
+profile_store = ProfileStore(int(conf['profile']['ttl']))
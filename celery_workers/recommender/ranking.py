@@ -0,0 +1,72 @@
+# coding=utf-8
+import time
+from typing import List, Optional
+
+import gensim
+import numpy as np
+
+from celery_workers.metrics import RECOMMEND_STAGE_SECONDS
+from celery_workers.recommender import conf
+from celery_workers.recommender.artifacts import Model
+from celery_workers.recommender.indexes import search, to_distances
+
+
+__all__ = ['gather_normed_vectors', 'normalize_rows', 'rank']
+
+
+def gather_normed_vectors(wv: gensim.models.KeyedVectors,
+                          indexes: np.ndarray) -> np.ndarray:
+    # normalized vectors of word indexes of any shape, -1 gives zeros
+    wv.fill_norms()
+    valid = indexes >= 0
+    safe_indexes = np.where(valid, indexes, 0)
+    vectors = wv.vectors[safe_indexes] / wv.norms[safe_indexes][..., np.newaxis]
+    vectors[~valid] = 0
+    return vectors
+
+
+def normalize_rows(arr: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(arr, axis=-1, keepdims=True)
+    return arr / np.where(norms == 0, 1, norms)
+
+
+def rank(model: Model, seed_indexes: np.ndarray,
+         profiles: Optional[np.ndarray] = None,
+         top_k: Optional[int] = None,
+         depth: Optional[int] = None) -> List[List[str]]:
+    # One batched faiss search for all the seeds, then every neighbor is
+    # re-ranked against the profile of its request at once. `profiles` is
+    # (n, dim), rows of NaN meaning "no profile, keep the faiss order".
+    # `depth` is the nprobe/efSearch of the search, see indexes.search.
+    wv, index = model.wv, model.index
+    top_k = top_k or int(conf['faiss']['search_top_k'])
+    seeds = gather_normed_vectors(wv, seed_indexes).astype(np.float32)
+    with RECOMMEND_STAGE_SECONDS.labels('faiss_search').time():
+        faiss_distances, faiss_indexes = search(index, seeds, top_k, depth)
+    faiss_distances = to_distances(index, faiss_distances)
+    rerank_started = time.perf_counter()
+
+    order = np.tile(np.arange(top_k), (len(seeds), 1))
+    if profiles is not None:
+        has_profile = ~np.isnan(profiles).any(axis=1)
+        if has_profile.any():
+            neighbors = gather_normed_vectors(wv, faiss_indexes[has_profile])
+            profile_vectors = normalize_rows(profiles[has_profile])
+            # cosine distances between every neighbor and its profile
+            profile_distances = 1 - np.einsum('nkd,nd->nk', neighbors,
+                                              profile_vectors)
+            weighted_distances = \
+                float(conf['recommender']['faiss_distance_weight']) \
+                * normalize_rows(faiss_distances[has_profile]) \
+                + float(conf['recommender']['user_profile_distance_weight']) \
+                * normalize_rows(profile_distances)
+            order[has_profile] = weighted_distances.argsort(axis=1)
+
+    ranked_indexes = np.take_along_axis(faiss_indexes, order, axis=1)
+    results = []
+    for seed_index, row in zip(seed_indexes, ranked_indexes):
+        results.append([wv.index_to_key[i] for i in row
+                        if i >= 0 and i != seed_index])
+    RECOMMEND_STAGE_SECONDS.labels('rerank').observe(
+        time.perf_counter() - rerank_started)
+    return results
@@ -0,0 +1,74 @@
+# coding=utf-8
+import functools
+from typing import Dict, List, Optional
+
+import msgpack
+
+from celery_workers.recommender import conf, r
+
+
+__all__ = ['RESULT_KEY_FORMAT', 'encode_paper_ids', 'store_result',
+           'stores_result']
+
+
+# keep in sync with gateways/results.py and gateways/main.py
+RESULT_KEY_FORMAT = "recommend-result-%s"
+INFLIGHT_KEY_FORMAT = "recommend-inflight-%s"
+
+
+def _encode_paper_id(paper_id: str):
+    # S2 ids are 40 hex digits, 20 bytes are enough
+    if len(paper_id) == 40:
+        try:
+            return bytes.fromhex(paper_id)
+        except ValueError:
+            pass
+    return paper_id
+
+
+def encode_paper_ids(paper_ids: Optional[List[str]]):
+    if paper_ids is None:
+        return None
+    return [_encode_paper_id(paper_id) for paper_id in paper_ids]
+
+
+def store_result(task_id: str, result: Dict, ttl: Optional[int] = None):
+    # Written under a well-known key with a TTL, and published on the
+    # channel of the same name for the gateways waiting on it. Celery's
+    # result backend isn't involved at all.
+    result = dict(result)
+    if 'paper_ids' in result:
+        result['paper_ids'] = encode_paper_ids(result['paper_ids'])
+    if 'results' in result:
+        result['results'] = [encode_paper_ids(paper_ids)
+                             for paper_ids in result['results']]
+    key = RESULT_KEY_FORMAT % task_id
+    payload = msgpack.packb(result, use_bin_type=True)
+    pipe = r.pipeline(transaction=False)
+    pipe.set(key, payload, ex=ttl or int(conf['results']['ttl']))
+    pipe.publish(key, payload)
+    pipe.delete(INFLIGHT_KEY_FORMAT % task_id)
+    pipe.execute()
+
+
+def stores_result(func):
+    # for bound tasks returning a dict, stores it as the result of the task;
+    # None (e.g. no model loaded yet) is stored as a failure
+    @functools.wraps(func)
+    def wrapper(task, *args, **kwargs):
+        try:
+            result = func(task, *args, **kwargs)
+        except Exception:
+            if task.request.id:
+                # short lived, so that the request can be retried soon
+                store_result(task.request.id, {'status': 'failed'},
+                             int(conf['results']['failed_ttl']))
+            raise
+        if task.request.id:
+            if result is None:
+                store_result(task.request.id, {'status': 'failed'},
+                             int(conf['results']['failed_ttl']))
+            else:
+                store_result(task.request.id, dict(result, status='ok'))
+        return result
+    return wrapper
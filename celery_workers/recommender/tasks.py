@@ -1,232 +1,431 @@
 # coding=utf-8
+import datetime
 import glob
 import gzip
 import json
 import os
-import random
 
 import numpy as np
 import pickle
 import time
 
 import faiss
-from typing import List, Optional, Iterator, Dict
+from typing import List, Optional, Iterator, Dict, Tuple, Union
 
 import gensim.models.doc2vec
 from celery.result import AsyncResult
-from sklearn.cluster import DBSCAN
-from sklearn.metrics.pairwise import cosine_distances
+from celery.signals import worker_init, worker_process_init
 
+from celery_workers.metrics import *
 from celery_workers.recommender import *
-
-index: Optional[faiss.IndexIVFFlat] = None
-wv: Optional[gensim.models.KeyedVectors] = None
-
-
-class yield_corpus:
-    def __init__(self,
-                 return_id: bool = False,
-                 check_word_id: bool = True):
-        self.return_id = return_id
-        self.check_word_id = check_word_id
-        self.cursor = None
-        self.first_run = True
-
-    def __iter__(self):
-        self.cursor = t_records.find()
-        if self.first_run:
-            self.first_run = False
-        else:
-            self.check_word_id = False
-        return self.generator()
-
-    def generator(self):
-        n = 0
-        last_time = time.time()
-        for record in self.cursor:
-            n += 1
-            if n % 100000 == 0:
-                logger.debug("[iter corpus] Processed 100000 records within %.2f s",
-                             time.time() - last_time)
-                last_time = time.time()
-
-            if 'Computer Science' not in record['fieldsOfStudy']:
-                continue
-            raw_words = record.get('outCitations') or record.get('inCitations')
-            if not raw_words or len(raw_words) < 4:
-                continue
-            raw_words = random.sample(raw_words, k=4)
-            raw_words.append(record['_id'])
-            random.shuffle(raw_words)
-
-            if self.return_id:
-                yield record['_id'], raw_words
-            yield raw_words
+from celery_workers.recommender.artifacts import *
+from celery_workers.recommender.calibration import *
+from celery_workers.recommender.clustering import *
+from celery_workers.recommender.corpus import *
+from celery_workers.recommender.graph import *
+from celery_workers.recommender.indexes import *
+from celery_workers.recommender.neighbors import *
+from celery_workers.recommender.profiles import *
+from celery_workers.recommender.ranking import *
+from celery_workers.recommender.results import *
+
+model_holder.on_swap.append(lambda model: author_profile_cache.clear())
+model_holder.on_swap.append(lambda model: observe_memory())
+
+
+@worker_init.connect
+def verify_current_version(**kwargs):
+    # in the main process, so that the children forked from it don't hash
+    # the artifacts again within worker_proc_alive_timeout
+    if not conf['artifacts'].getboolean('load_on_start'):
+        return
+    version = current_version()
+    if version is None:
+        return
+    try:
+        verify_once(version)
+    except Exception:
+        logger.exception("[artifacts] unable to verify version %s", version)
+
+
+@worker_process_init.connect
+def load_model_on_start(**kwargs):
+    # otherwise the first task of every process pays for the loading
+    if not conf['artifacts'].getboolean('load_on_start'):
+        return
+    started = time.perf_counter()
+    model_holder.refresh()
+    elapsed = time.perf_counter() - started
+    WORKER_STARTUP_SECONDS.set(elapsed)
+    memory = observe_memory()
+    logger.info("[artifacts] process %d ready within %.2f s, rss %s",
+                os.getpid(), elapsed,
+                ', '.join('%s %.1f MiB' % (kind, value / (1 << 20))
+                          for kind, value in memory.items()))
+
+
+def stage_model(model: gensim.models.word2vec.Word2Vec) -> Tuple[str, str]:
+    # saves a trained model in the staging directory of a new version,
+    # returns (version, staging); the caller drops the model afterwards,
+    # only its vectors are needed from then on
+    version = new_version()
+    staging = create_staging(version)
+    model.save(os.path.join(staging, W2V_MODEL_FILENAME))
+    # every array in its own .npy file, memory mapped by the workers
+    model.wv.save(os.path.join(staging, WV_FILENAME), sep_limit=0)
+    logger.info("[word2vec] word_vectors saved to %s", staging)
+    return version, staging
+
+
+def publish_model(version: str, staging: str,
+                  wv: gensim.models.KeyedVectors, index: faiss.Index,
+                  extra: Dict):
+    # completes the staged version with its index, publishes it and swaps
+    # it in, then sends the tasks deriving the other tables from it
+    faiss.write_index(index, os.path.join(staging, INDEX_FILENAME))
+    publish(version, staging, extra)
+    model_holder.set(Model(version, wv, index))
+    send_post_publish_tasks(version)
 
 
 @app.task(name="recommender.process_database")
 def task_process_database():
-    global index, wv
-
+    trained_until = datetime.datetime.utcnow()
+    seed = int(conf['corpus']['seed'])
     model = gensim.models.word2vec.Word2Vec(
-        sentences=yield_corpus(),
+        corpus_file=export_corpus('full', seed),
         vector_size=int(conf['recommender']['vector_size']),
         workers=int(conf['recommender']['workers']),
         min_count=int(conf['recommender']['min_count']),
-        epochs=int(conf['recommender']['epochs']))
-    # model.train(iter(corpus),
-    #             total_examples=model.corpus_count,
-    #             epochs=int(conf['recommender']['epochs']))
+        epochs=int(conf['recommender']['epochs']),
+        seed=seed)
     logger.debug("[word2vec] Model trained")
 
     wv = model.wv
+    version, staging = stage_model(model)
     del model
-    wv.save(conf['recommender']['word2vec_wv_path'])
-    logger.info("[word2vec] word_vectors saved to %s",
-                conf['recommender']['word2vec_wv_path'])
-
-    # model = gensim.models.doc2vec.Doc2Vec.load(
-    #     conf['recommender']['word2vec_wv_path'])
 
     wv.init_sims()
 
     logger.debug("Building faiss index")
-    quantizer = faiss.IndexFlatL2(int(conf['faiss']['dimension']))
-    index = faiss.IndexIVFFlat(quantizer,
-                               int(conf['faiss']['dimension']),
-                               int(conf['faiss']['nlist']),
-                               faiss.METRIC_L2)
-    vectors = wv.get_normed_vectors()
-    index.train(vectors)
-    logger.debug("Faiss index trained")
-    index.add(vectors)
-    index.nprobe = int(conf['faiss']['nprobe'])
-    faiss.write_index(index, conf['faiss']['path'])
-    logger.debug("Faiss index saved to %s", conf['faiss']['path'])
-
-
-def normalize(arr: np.ndarray, inplace: bool = False):
-    norm = np.linalg.norm(arr)
-    if norm == 0:
-        return arr
-
-    if not inplace:
-        return arr / norm
-    else:
-        arr /= norm
-        return arr
-
-
-@app.task(name="recommender.recommend")
-def task_recommend(author_id: Optional[str],
-                   from_paper_id: str,
-                   visited_ids: List[str]):
-    try:
-        from_paper_vector = wv.get_vector(from_paper_id, norm=True)
-    except:
+    index = build_index(wv.get_normed_vectors())
+
+    publish_model(version, staging, wv, index, {
+        'kind': 'full',
+        'trained_until': trained_until.isoformat(),
+        'full_build_size': len(wv),
+        'drift': 0.,
+    })
+
+
+def measure_drift(before: np.ndarray, after: np.ndarray) -> float:
+    # mean cosine distance between two versions of the same vectors
+    before = before / np.linalg.norm(before, axis=1, keepdims=True)
+    after = after / np.linalg.norm(after, axis=1, keepdims=True)
+    return float(np.mean(1 - np.sum(before * after, axis=1)))
+
+
+@app.task(name="recommender.update_model")
+def task_update_model():
+    # Keep training the current model on the records ingested since it was
+    # trained and add the new vectors to a copy of its index; the quantizer
+    # isn't retrained. Falls back to process_database once the vectors
+    # drifted too far from the ones the index was built with.
+    current = model_holder.get()
+    if current is None:
+        return task_process_database()
+    manifest = read_manifest(current.version)
+
+    trained_until = datetime.datetime.utcnow()
+    corpus_file = export_corpus(
+        'incremental', int(conf['corpus']['seed']), ingested_since(
+            datetime.datetime.fromisoformat(manifest['trained_until'])))
+    model = gensim.models.word2vec.Word2Vec.load(
+        get_version_path(current.version, W2V_MODEL_FILENAME))
+    n_old = len(model.wv)
+    model.build_vocab(corpus_file=corpus_file, update=True)
+    if model.corpus_count == 0:
+        logger.info("[word2vec] Nothing new since %s",
+                    manifest['trained_until'])
+        return
+
+    rng = np.random.default_rng()
+    sample = rng.choice(n_old, size=min(n_old, int(
+        conf['incremental']['drift_sample_size'])), replace=False)
+    sampled_before = model.wv.vectors[sample].copy()
+    model.train(corpus_file=corpus_file, total_examples=model.corpus_count,
+                total_words=model.corpus_total_words,
+                epochs=int(conf['incremental']['epochs']))
+    drift = manifest['drift'] + measure_drift(sampled_before,
+                                              model.wv.vectors[sample])
+    new_ratio = len(model.wv) / manifest['full_build_size'] - 1
+    logger.info("[word2vec] Incremental update: %d new vectors, "
+                "drift %.4f, %.2f%% more vectors than the full build",
+                len(model.wv) - n_old, drift, new_ratio * 100)
+    if drift > float(conf['incremental']['max_drift']) \
+            or new_ratio > float(conf['incremental']['max_new_ratio']):
+        logger.info("[word2vec] Drifted too far, rebuilding from scratch")
+        del model
+        return task_process_database()
+
+    wv = model.wv
+    version, staging = stage_model(model)
+    del model
+
+    wv.fill_norms(force=True)
+    # a writable copy, the index in use may be memory mapped read only
+    index = faiss.read_index(get_version_path(current.version,
+                                              INDEX_FILENAME))
+    set_search_depth(index)
+    index.add(wv.vectors[n_old:] / wv.norms[n_old:, np.newaxis])
+
+    publish_model(version, staging, wv, index, {
+        'kind': 'incremental',
+        'parent': current.version,
+        'trained_until': trained_until.isoformat(),
+        'full_build_size': manifest['full_build_size'],
+        'drift': drift,
+    })
+
+
+def send_post_publish_tasks(version: str):
+    # tables derived from a published version: attached to it, except the
+    # neighbors, written to mongo for the gateways
+    app.send_task('recommender.calibrate_search',
+                  args=(version,), ignore_result=True)
+    if conf['neighbors'].getboolean('enabled'):
+        app.send_task('recommender.build_neighbor_table',
+                      args=(version,), ignore_result=True)
+    if conf['graph'].getboolean('enabled'):
+        app.send_task('recommender.build_citation_graph',
+                      args=(version,), ignore_result=True)
+
+
+def get_current_model(version: str) -> Optional[Model]:
+    # None once `version` is no longer the current one
+    model = model_holder.get()
+    if model is None or model.version != version:
+        model_holder.refresh()
+        model = model_holder.get()
+    if model is None or model.version != version:
+        logger.info("[artifacts] version %s is no longer current, skipped",
+                    version)
         return None
+    return model
 
-    interest_papers_vectors = []  # to make PyCharm happy
-    if author_id:
-        author = t_authors.find_one({'_id': author_id})
-        paper_ids = author['papers']
-        interest_papers_vectors = []
-        for paper_id in paper_ids:
-            record = t_records.find_one({'_id': paper_id})
-            if record is None:
-                logger.error("Unable to find paper with _id=%s", paper_id)
-                continue
-            try:
-                vec = wv.get_vector(paper_id, norm=True)
-                interest_papers_vectors.append(vec)
-            except KeyError:
-                continue
-
-            citation_paper_ids = record['outCitations']
-            for citation_paper_id in citation_paper_ids:
-                try:
-                    vec = wv.get_vector(citation_paper_id, norm=True)
-                    interest_papers_vectors.append(vec)
-                except KeyError:
-                    continue
-
-    user_profile_vector = None  # to make PyCharm happy
-    if author_id or visited_ids:
-        interest_papers_centers = []
-        if visited_ids:
-            for paper_id in visited_ids:
-                try:
-                    vec = wv.get_vector(paper_id, norm=True)
-                    interest_papers_vectors.append(vec)
-                except KeyError:
-                    continue
-        interest_papers_vectors = np.array(interest_papers_vectors)
-        clustering = DBSCAN(eps=float(conf['dbscan']['eps']),
-                            min_samples=int(conf['dbscan']['min_samples'])
-                            ).fit(interest_papers_vectors)
-        core_samples_mask = np.zeros_like(clustering.labels_, dtype=bool)
-        core_samples_mask[clustering.core_sample_indices_] = True
-        unique_labels = set(clustering.labels_)
-        for label in unique_labels:
-            if label == -1:
-                continue
-            class_member_mask = (clustering.labels_ == label)
-            interest_papers_centers.append(
-                np.average(interest_papers_vectors[class_member_mask], axis=0))
-        if len(interest_papers_centers) <= 2:
-            interest_papers_centers = interest_papers_vectors
-        else:
-            interest_papers_centers = np.array(interest_papers_centers)
-
-        user_profile_vector = np.mean(interest_papers_centers,
-                                      axis=0, keepdims=True)
-
-    faiss_distances, faiss_indexes = index.search(
-        np.array([from_paper_vector]).astype('float32'),
-        int(conf['faiss']['search_top_k']))
-    faiss_distances = faiss_distances[0]
-    faiss_indexes = faiss_indexes[0]
-    similar_paper_vectors = []
-    similar_paper_ids = []
-    for faiss_distance, faiss_index in zip(faiss_distances, faiss_indexes):
-        faiss_paper_id = wv.index_to_key[faiss_index]
-        vec = wv.get_vector(faiss_paper_id, norm=True)
-        similar_paper_vectors.append(vec)
-        similar_paper_ids.append(faiss_paper_id)
-    similar_paper_vectors = np.array(similar_paper_vectors)
 
+@app.task(name="recommender.build_neighbor_table", ignore_result=True)
+def task_build_neighbor_table(version: str):
+    model = get_current_model(version)
+    if model is not None:
+        build_neighbor_table(model)
+
+
+@app.task(name="recommender.build_citation_graph", ignore_result=True)
+def task_build_citation_graph(version: str):
+    model = get_current_model(version)
+    if model is not None:
+        build_citation_graph(model)
+
+
+@app.task(name="recommender.calibrate_search", ignore_result=True)
+def task_calibrate_search(version: str):
+    # recall/latency of the search depths, see [search_budget]
+    model = get_current_model(version)
+    if model is not None:
+        build_calibration(model)
+
+
+def get_profile_vector(model: Model,
+                       author_id: Optional[str] = None,
+                       visited_ids: Optional[List[str]] = None,
+                       user_id: Optional[str] = None) -> Optional[np.ndarray]:
+    if user_id:
+        return profile_store.get_or_build(model.wv, model.version, user_id)
     if author_id or visited_ids:
-        user_profile_distances = cosine_distances(
-            similar_paper_vectors, user_profile_vector)[..., 0]
-        final_paper_ids = []
-        faiss_distance_weight = float(conf['recommender']['faiss_distance_weight'])
-        normalized_faiss_distances = normalize(faiss_distances)
-        user_profile_distance_weight = float(conf['recommender']['user_profile_distance_weight'])
-        normalized_user_profile_distances = normalize(user_profile_distances)
-        weighted_distances = \
-            faiss_distance_weight * normalized_faiss_distances \
-            + user_profile_distance_weight * normalized_user_profile_distances
-        for sorted_index in weighted_distances.argsort():
-            final_paper_ids.append(similar_paper_ids[sorted_index])
-    else:
-        final_paper_ids = similar_paper_ids
-
-    from_paper_index = final_paper_ids.index(from_paper_id)
-    if from_paper_index != -1:
-        final_paper_ids.pop(from_paper_index)
-
-    return final_paper_ids
+        with RECOMMEND_STAGE_SECONDS.labels('profile_fetch').time():
+            interest_papers_vectors = lookup_normed_vectors(
+                model.wv, visited_ids or [])
+            if author_id:
+                interest_papers_vectors = np.concatenate([
+                    get_author_interest_vectors(model.wv, author_id),
+                    interest_papers_vectors])
+        with RECOMMEND_STAGE_SECONDS.labels('clustering').time():
+            interest_papers_centers, _ = cluster_interest_vectors(
+                interest_papers_vectors)
+        if len(interest_papers_centers):
+            return np.mean(interest_papers_centers, axis=0, keepdims=True)
+    return None
+
+
+@app.task(name="recommender.recommend", bind=True, ignore_result=True)
+@stores_result
+def task_recommend(self,
+                   author_id: Optional[str],
+                   from_paper_id: str,
+                   visited_ids: Optional[List[str]] = None,
+                   user_id: Optional[str] = None,
+                   model_version: Optional[str] = None,
+                   budget: Union[None, str, Dict] = None):
+    # budget: a [search_budget] preset or {'latency_ms', 'recall'}
+    model = model_holder.get()
+    if model_version and (model is None or model.version != model_version):
+        # the result is cached under the version the gateway saw
+        model_holder.refresh()
+        model = model_holder.get()
+    if model is None:
+        logger.warning("[recommend] no model loaded, skipped")
+        return None
+    setting = search_calibrations.get_setting(model, budget)
+    results = recommend_many(model, [(from_paper_id, get_profile_vector(
+        model, author_id, visited_ids, user_id))], setting)
+    return {'model_version': model.version, 'paper_ids': results[0],
+            'search': setting}
+
+
+def recommend_many(model: Model, requests,
+                   setting: Optional[Dict] = None
+                   ) -> List[Optional[List[str]]]:
+    # requests: (from_paper_id, profile vector or None) pairs, setting: the
+    # search depth and k, see SearchCalibrations.get_setting
+    key_to_index = model.wv.key_to_index
+    known = [i for i, (paper_id, _) in enumerate(requests)
+             if paper_id in key_to_index]
+    results = [None] * len(requests)
+    if not known:
+        return with_citation_graph(model, requests, results)
+
+    seed_indexes = np.array([key_to_index[requests[i][0]] for i in known])
+    profiles = np.full((len(known), model.wv.vector_size), np.nan,
+                       dtype=np.float32)
+    for row, i in enumerate(known):
+        if requests[i][1] is not None:
+            profiles[row] = np.ravel(requests[i][1])
+    setting = setting or {}
+    # a larger k widens the candidates of the re-ranking, not the results
+    n_results = int(conf['faiss']['search_top_k'])
+    for i, paper_ids in zip(known, rank(model, seed_indexes, profiles,
+                                        setting.get('k'),
+                                        setting.get('depth'))):
+        results[i] = paper_ids[:n_results]
+    return with_citation_graph(model, requests, results)
+
+
+def with_citation_graph(model: Model, requests,
+                        results: List[Optional[List[str]]]
+                        ) -> List[Optional[List[str]]]:
+    # papers without an embedding are served from the citation graph, the
+    # others optionally re-ranked with it
+    graph = citation_graphs.get(model)
+    if graph is None:
+        return results
+    weight = float(conf['graph']['rerank_weight'])
+    n_results = int(conf['faiss']['search_top_k'])
+    with RECOMMEND_STAGE_SECONDS.labels('graph').time():
+        for i, (paper_id, _) in enumerate(requests):
+            if results[i] is None:
+                results[i] = graph.recommend(paper_id, n_results)
+            elif weight > 0:
+                results[i] = graph.rerank(paper_id, results[i], weight)
+    return results
+
+
+@app.task(name="recommender.recommend_batch", bind=True, ignore_result=True)
+@stores_result
+def task_recommend_batch(self, requests: List[List[Optional[str]]],
+                         budget: Union[None, str, Dict] = 'batch'):
+    # requests: [user_id or None, from_paper_id] pairs, the results are
+    # aligned with them (None for papers without an embedding)
+    model = model_holder.get()
+    if model is None:
+        logger.warning("[recommend] no model loaded, skipped")
+        return None
+    setting = search_calibrations.get_setting(model, budget)
+    profiles = {}
+    for user_id, _ in requests:
+        if user_id and user_id not in profiles:
+            profiles[user_id] = get_profile_vector(model, user_id=user_id)
+    results = recommend_many(model, [
+        (paper_id, profiles.get(user_id) if user_id else None)
+        for user_id, paper_id in requests], setting)
+    return {'model_version': model.version, 'results': results,
+            'search': setting}
+
+
+@app.task(name="recommender.evaluate_clustering")
+def task_evaluate_clustering(n_users: int = 100):
+    # quality of the bounded clustering against an uncapped DBSCAN, on the
+    # heaviest users (the ones it is meant for)
+    model = model_holder.get()
+    if model is None:
+        logger.warning("[clustering eval] no model loaded, skipped")
+        return None
+    users = t_users.aggregate([
+        {'$project': {'author_id': 1,
+                      'n_visited': {'$size': {'$ifNull': ['$visited', []]}}}},
+        {'$sort': {'n_visited': -1}},
+        {'$limit': n_users},
+    ])
+    results = []
+    for user in users:
+        vectors = lookup_normed_vectors(
+            model.wv, t_users.find_one({'_id': user['_id']},
+                                       {'visited': 1}).get('visited') or [])
+        if user.get('author_id'):
+            vectors = np.concatenate([
+                get_author_interest_vectors(model.wv, user['author_id']),
+                vectors])
+        if len(vectors):
+            results.append(compare_with_dbscan(vectors))
+    if results:
+        logger.info("[clustering eval] mean similarity %.4f over %d users, "
+                    "%.3f s -> %.3f s on average",
+                    np.mean([i['similarity'] for i in results]), len(results),
+                    np.mean([i['dbscan_seconds'] for i in results]),
+                    np.mean([i['seconds'] for i in results]))
+    return results
 
 
 @app.task(name="recommender.load_from_disk")
 def task_load_from_disk():
-    global index, wv
-    index = faiss.read_index(conf['faiss']['path'])
-    # noinspection PyTypeChecker
-    wv = gensim.models.KeyedVectors.load(
-        conf['recommender']['word2vec_wv_path'])  # type: gensim.models.KeyedVectors
+    # the other worker processes pick up the current version by themselves
+    model_holder.refresh()
+
+
+@app.task(name="recommender.update_profile", ignore_result=True)
+def task_update_profile(user_id: str, paper_id: str):
+    model = model_holder.get()
+    if model is None:
+        # picked up by the next build of the profile instead
+        logger.warning("[profiles] no model loaded, visit of %s skipped",
+                       user_id)
+        return
+    profile_store.add_visit(model.wv, model.version, user_id, paper_id)
+    # only now, or a recommendation requested meanwhile would be computed
+    # from the previous profile and cached as the new one
+    profile_store.bump_revision(user_id)
+
+
+@app.task(name="recommender.evaluate_indexes")
+def task_evaluate_indexes():
+    # recall@k against exact search, latency and memory of each candidate
+    model = model_holder.get()
+    if model is None:
+        logger.warning("[faiss eval] no model loaded, skipped")
+        return None
+    results = evaluate_index_types(
+        model.wv.get_normed_vectors(),
+        conf['faiss_eval']['index_types'].split(','),
+        conf['faiss_eval']['metrics'].split(','),
+        int(conf['faiss_eval']['n_queries']),
+        int(conf['faiss']['search_top_k']))
+    with open(conf['faiss_eval']['path'], 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info("[faiss eval] results saved to %s", conf['faiss_eval']['path'])
+    return results
 
 
+# no longer sent, kept for the messages still queued
 @app.task(name="recommender.clear_async_result")
 def task_clear_async_result(task_id):
     async_result = AsyncResult(id=task_id, app=app)
@@ -28,12 +28,16 @@ celery_app = celery.Celery("gateways",
                            broker=conf['mq']['url'])
 celery_app.config_from_object('gateways.celeryconfig')
 
-dbclient = pymongo.MongoClient(conf['db']['url'])
+dbclient = pymongo.MongoClient(
+    conf['db']['url'], maxPoolSize=int(conf['pool']['mongo_max_pool_size']))
 db = dbclient[conf['db']['db_name']]  # type: pymongo.database.Database
 t_authors = db['authors']  # type: pymongo.database.Collection
 t_records = db['records']  # type: pymongo.database.Collection
 t_users = db['users']  # type: pymongo.database.Collection
+t_neighbors = db['neighbors']  # type: pymongo.database.Collection
 
-r = redis.Redis(host=conf['redis']['host'],
-                port=conf['redis']['port'],
-                db=conf['redis']['db'])
+r = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+    host=conf['redis']['host'],
+    port=conf['redis']['port'],
+    db=conf['redis']['db'],
+    max_connections=int(conf['pool']['redis_max_connections'])))
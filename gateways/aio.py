@@ -0,0 +1,21 @@
+# coding=utf-8
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from gateways import conf
+
+
+__all__ = ['io_executor', 'run_io']
+
+
+# pymongo and redis-py are blocking, run them off the event loop in a
+# bounded pool so that a slow query only ties up one of these threads
+io_executor = ThreadPoolExecutor(max_workers=int(conf['pool']['io_workers']),
+                                 thread_name_prefix='gateway-io')
+
+
+async def run_io(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        io_executor, functools.partial(func, *args, **kwargs))
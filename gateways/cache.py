@@ -0,0 +1,164 @@
+# coding=utf-8
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional, Tuple
+
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from gateways import conf, logger
+from gateways.aio import run_io
+from gateways.metrics import CACHE_LOOKUPS
+
+
+__all__ = ['LRUCache', 'RecordCache', 'record_cache']
+
+
+class LRUCache:
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key: str) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self.pop(key)
+            return None
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        self.pop(key)
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.nbytes += len(value)
+        while len(self.data) > self.max_entries \
+                or self.nbytes > self.max_bytes:
+            _, (_, evicted) = self.data.popitem(last=False)
+            self.nbytes -= len(evicted)
+
+    def pop(self, key: str):
+        item = self.data.pop(key, None)
+        if item is not None:
+            self.nbytes -= len(item[1])
+
+    def clear(self):
+        self.data.clear()
+        self.nbytes = 0
+
+
+class RecordCache:
+    # Serialized /record responses, keyed by the record key (`_id` or
+    # `doi:...`), in a per-process LRU in front of redis. The datafeeder
+    # deletes the redis entries of the records it rewrites and announces
+    # them on INVALIDATION_CHANNEL (keep both in sync with
+    # celery_workers/datafeeder/utils.py). An entry is "<_id>\n<response>",
+    # so that a `doi:...` hit knows the record without parsing the response.
+    KEY_FORMAT = "record-cache-%s"
+    INVALIDATION_CHANNEL = "record-cache-invalidate"
+
+    def __init__(self, local: LRUCache, ttl: int, r: Optional[Redis] = None):
+        if r is None:
+            from gateways import r as _r
+            r = _r
+        self.r = r
+        self.local = local
+        self.ttl = ttl
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.loop = None  # type: Optional[asyncio.AbstractEventLoop]
+
+    @staticmethod
+    def _split(value: bytes) -> Optional[Tuple[str, bytes]]:
+        record_id, sep, content = value.partition(b'\n')
+        if not sep:
+            # written before the _id was stored along
+            return None
+        return record_id.decode(), content
+
+    async def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        # (record _id, response)
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            CACHE_LOOKUPS.labels('record', 'local_hit').inc()
+            return self._split(value)
+        value = await run_io(self.r.get, self.KEY_FORMAT % key)
+        if value is not None and self._split(value) is not None:
+            self.redis_hits += 1
+            CACHE_LOOKUPS.labels('record', 'redis_hit').inc()
+            self.local.put(key, value)
+            return self._split(value)
+        self.misses += 1
+        CACHE_LOOKUPS.labels('record', 'miss').inc()
+        return None
+
+    async def put(self, keys: Iterable[str], record_id: str, content: bytes):
+        value = record_id.encode() + b'\n' + content
+        keys = list(keys)
+        for key in keys:
+            self.local.put(key, value)
+
+        def _put():
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(self.KEY_FORMAT % key, value, ex=self.ttl)
+            pipe.execute()
+        await run_io(_put)
+
+    def invalidate_local(self, keys: Iterable[str]):
+        for key in keys:
+            self.local.pop(key)
+
+    def stats(self):
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            'local_hits': self.local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.local_hits + self.redis_hits) / lookups
+            if lookups else None,
+            'local_entries': len(self.local),
+            'local_bytes': self.local.nbytes,
+        }
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        threading.Thread(target=self._listen, daemon=True,
+                         name='record-cache-invalidation').start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    self.loop.call_soon_threadsafe(
+                        self.invalidate_local, json.loads(message['data']))
+            except ConnectionError:
+                logger.exception("Lost the invalidation subscription, "
+                                 "retrying")
+                # entries may have been missed meanwhile
+                self.loop.call_soon_threadsafe(self.local.clear)
+                time.sleep(1)
+
+
+record_cache = RecordCache(
+    LRUCache(int(conf['record_cache']['local_max_entries']),
+             int(conf['record_cache']['local_max_bytes']),
+             float(conf['record_cache']['local_ttl'])),
+    int(conf['record_cache']['redis_ttl']))
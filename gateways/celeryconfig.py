@@ -2,6 +2,9 @@
 
 time_zone = 'UTC'
 
+# expire results in the backend itself instead of forgetting them by hand
+result_expires = 3600
+
 task_annotations = {
     "authors.append_orcid": {"rate_limit": '22/s'},  # orcid limits
 }
@@ -1,28 +1,73 @@
 # coding=utf-8
+import asyncio
+import base64
 import hashlib
+import hmac
+import json
+import time
 
-from bson import ObjectId
-from celery.result import AsyncResult
-from fastapi import FastAPI, HTTPException, Cookie, Request
+from fastapi import FastAPI, HTTPException, Cookie, Header, Request
 from marshmallow import EXCLUDE
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import Response
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel
 
 from gateways import *
+from gateways.aio import run_io
+from gateways.cache import record_cache
+from gateways.metrics import REQUEST_SECONDS
+from gateways.queries import *
+from gateways.results import result_waiter
 from gateways.schemas import OutputRecordSchema
 from gateways.session import session_manager
+from gateways.users import user_summary_cache, visit_history
 
 
+@app.middleware("http")
+async def observe_request_time(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # labelled by handler rather than path, paths embed record keys
+        endpoint = request.scope.get('endpoint')
+        REQUEST_SECONDS.labels(
+            request.method,
+            endpoint.__name__ if endpoint is not None else 'unmatched',
+            status).observe(time.perf_counter() - started)
+
+
+@app.get("/metrics")
+async def query_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.on_event("startup")
+async def start_result_waiter():
+    result_waiter.start(asyncio.get_event_loop())
+
+
+@app.on_event("startup")
+async def start_visit_history_flusher():
+    asyncio.ensure_future(visit_history.flush_forever(
+        float(conf['visits']['flush_interval']),
+        int(conf['visits']['flush_batch_size'])))
+
+
+@app.on_event("startup")
+async def start_record_cache():
+    record_cache.start(asyncio.get_event_loop())
+
 
 def _query_record(key):
-    if key.startswith('doi:'):
-        query = {'doi': key[len('doi:'):]}
-    elif len(key) == 40:
-        query = {'_id': key}
-    else:
+    query = record_filter(key)
+    if query is None:
         raise HTTPException(status_code=400, detail="unknown key pattern")
 
     record = t_records.find_one(query)
@@ -31,39 +76,118 @@ def _query_record(key):
     return record
 
 
+def _record_visit(user, record_id):
+    user_id = str(user['_id'])
+    if visit_history.add(user_id, record_id):
+        celery_app.send_task("recommender.update_profile",
+                             args=(user_id, record_id))
+
+
 @app.get("/record/{key:path}")
 async def query_record(key: str, no_record_history: bool = False,
                        session: Optional[str] = Cookie(None)):
-    record = _query_record(key)
+    cached = await record_cache.get(key)
+    if cached is None:
+        record = await run_io(_query_record, key)
+        schema = OutputRecordSchema(unknown=EXCLUDE, partial=True)
+        content = json.dumps(schema.dump(schema.load(record))).encode()
+        record_id = str(record['_id'])
+        cache_keys = [record_id]
+        if record.get('doi'):
+            cache_keys.append('doi:' + record['doi'])
+        await record_cache.put(cache_keys, record_id, content)
+    else:
+        record_id, content = cached
 
     if session is not None and not no_record_history:
-        user = get_user(session)
-        record_id = str(record['_id'])
-        if record_id not in user['visited']:
-            t_users.update_one({'_id': user['_id']},
-                               {'$push': {'visited': str(record['_id'])}})
+        user = await run_io(get_user, session)
+        await run_io(_record_visit, user, record_id)
+
+    return Response(content=content, media_type='application/json')
+
+
+@app.get("/stats/record-cache")
+async def query_record_cache_stats():
+    return record_cache.stats()
+
+
+# keep in sync with celery_workers/datafeeder/utils.py
+TITLE_AUTOCOMPLETE_KEY = "autocomplete-titles"
+
+
+def _encode_search_cursor(score: float, record_id: str) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps([score, record_id]).encode()).decode()
 
-    schema = OutputRecordSchema(unknown=EXCLUDE, partial=True)
-    return schema.dump(schema.load(record))
+
+def _decode_search_cursor(cursor: str):
+    try:
+        score, record_id = json.loads(base64.urlsafe_b64decode(cursor))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return score, record_id
+
+
+def _search_records(query_str: str, cursor: Optional[str], limit: int):
+    # a cursor is the last (score, _id) returned; only the fields of a
+    # result list are fetched
+    after = _decode_search_cursor(cursor) if cursor is not None else None
+    records = list(t_records.aggregate(search_pipeline(
+        query_str, SEARCH_RESULT_FIELDS, after, limit)))
+    total_number = None
+    if cursor is None:
+        counted = list(t_records.aggregate(search_count_pipeline(query_str)))
+        total_number = counted[0]['n'] if counted else 0
+    return records, total_number
 
 
 @app.post('/search/record')
-async def search_record(query_str: str):
-    query = { '$text': { '$search': query_str } }
-    projection = { 'score': { '$meta': 'textScore' } }
-    a_sort = [( 'score', { '$meta': 'textScore' } )]
-    results = t_records.find(query, projection).sort(a_sort).limit(50)
-    schema = OutputRecordSchema(unknown=EXCLUDE, partial=True)
+async def search_record(query_str: str, cursor: Optional[str] = None,
+                        limit: int = 20):
+    # totalNumber is only counted for the first page
+    limit = max(1, min(limit, int(conf['search']['max_page_size'])))
+    results, total_number = await run_io(_search_records,
+                                         query_str, cursor, limit)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = _encode_search_cursor(results[-1]['score'],
+                                            results[-1]['_id'])
+    schema = OutputRecordSchema(only=SEARCH_RESULT_FIELDS,
+                                unknown=EXCLUDE, partial=True)
     records = schema.dump(schema.load(results, many=True), many=True)
-    return {
-        'totalNumber': len(records),
+    response = {
         'records': records,
+        'nextCursor': next_cursor,
     }
+    if total_number is not None:
+        response['totalNumber'] = total_number
+    return response
+
+
+def normalize_title(title: str) -> str:
+    return ' '.join(title.lower().split())
+
+
+@app.get('/search/autocomplete')
+async def autocomplete_record_title(prefix: str, limit: int = 10):
+    prefix = normalize_title(prefix).encode()
+    if not prefix:
+        return {'records': []}
+    limit = max(1, min(limit, int(conf['search']['max_page_size'])))
+    members = await run_io(r.zrangebylex, TITLE_AUTOCOMPLETE_KEY,
+                           b'[' + prefix, b'[' + prefix + b'\xff',
+                           start=0, num=limit)
+    records = []
+    for member in members:
+        _, record_id, title = member.decode().split('\0', 2)
+        records.append({'_id': record_id, 'title': title})
+    return {'records': records}
 
 
 @app.get('/author/{author_id}')
 async def query_author(author_id: int):
-    results = t_authors.find_one({'_id': author_id})
+    results = await run_io(t_authors.find_one, {'_id': author_id})
     return results
 
 
@@ -75,11 +199,13 @@ class UserRegistrationModel(BaseModel):
 
 @app.put("/user/homepage")
 async def register_user(req: UserRegistrationModel, resp: Response):
-    same_email = t_users.find_one({'email': req.email})
+    same_email = await run_io(t_users.find_one,
+                              user_by_email_filter(req.email))
     if same_email is not None:
         raise HTTPException(status_code=400,
                             detail="The email has been registered!")
-    same_author = t_users.find_one({'author_id': req.author_id})
+    same_author = await run_io(t_users.find_one,
+                               user_by_author_filter(req.author_id))
     if same_author is not None:
         raise HTTPException(status_code=400,
                             detail='The author has been registered!')
@@ -90,10 +216,10 @@ async def register_user(req: UserRegistrationModel, resp: Response):
 
     new_user = req.dict()
     new_user['visited'] = []
-    result = t_users.insert_one(new_user)
+    result = await run_io(t_users.insert_one, new_user)
     user_id = str(result.inserted_id)
 
-    sess_key = session_manager.new_item({'user_id': user_id})
+    sess_key = await run_io(session_manager.new_item, {'user_id': user_id})
     resp.set_cookie(key='session', value=sess_key,
                     expires=int(conf['gateway']['cookie_expires']))
 
@@ -109,13 +235,14 @@ async def login_user(req: UserLoginModel, resp: Response):
     req.hashed_password = hashlib.md5(
         (req.hashed_password + password_salt).encode()).hexdigest()
 
-    user = t_users.find_one({'email': req.email,
-                             'hashed_password': req.hashed_password})
+    user = await run_io(t_users.find_one,
+                        login_filter(req.email, req.hashed_password))
     if user is None:
         raise HTTPException(status_code=404,
                             detail='Invalid credentials')
 
-    sess_key = session_manager.new_item({'user_id': str(user['_id'])})
+    sess_key = await run_io(session_manager.new_item,
+                            {'user_id': str(user['_id'])})
     resp.set_cookie(key='session', value=sess_key,
                     expires=int(conf['gateway']['cookie_expires']))
 
@@ -128,9 +255,10 @@ async def logout_user():
 
 
 def get_user(sess_key, raise_exc: bool = True):
-    if sess_key:
-        user_id = ObjectId(session_manager[sess_key]['user_id'])
-        user = t_users.find_one({'_id': user_id})
+    # a summary of the user (_id, author_id, email), not the whole document
+    session = session_manager.get(sess_key) if sess_key else None
+    if session is not None:
+        user = user_summary_cache.get(session['user_id'])
     else:
         user = None
     if user is None:
@@ -149,28 +277,170 @@ def get_user_id(sess_key, *args, **kwargs):
     return str(user['_id'])
 
 
-@app.put("/recommend/record/{key:path}")
-async def request_recommend_records(key: str, session: Optional[str] = Cookie(None)):
-    user = get_user(session, raise_exc=False)
-    visited_ids = user['visited'] if user else None
+# keep in sync with celery_workers/recommender/{artifacts,results}.py
+MODEL_VERSION_KEY = "recommender-model-version"
+RECOMMEND_INFLIGHT_KEY_FORMAT = "recommend-inflight-%s"
+_model_version = (0., None)
+
+
+def _get_model_version() -> Optional[str]:
+    global _model_version
+    checked_at, version = _model_version
+    if time.time() - checked_at >= float(
+            conf['recommend']['model_version_check_interval']):
+        version = r.get(MODEL_VERSION_KEY)
+        version = version.decode() if version is not None else None
+        _model_version = (time.time(), version)
+    return version
+
+
+def _send_recommend_task(author_id, record_id, user_id):
+    # Identical requests (same paper, profile and model version) share one
+    # id: the first one sends the task, the others wait for its result, and
+    # later ones read it while it's kept (see [results] ttl on the
+    # recommender). A new model version changes every id.
+    model_version = _get_model_version()
+    profile_hash = '%s-%d' % (user_id, visit_history.get_revision(user_id)) \
+        if user_id else ''
+    result_id = hashlib.sha1('\0'.join([
+        model_version or '', record_id, profile_hash]).encode()).hexdigest()
+
+    pipe = r.pipeline()
+    pipe.exists(result_waiter.KEY_PREFIX + result_id)
+    pipe.set(RECOMMEND_INFLIGHT_KEY_FORMAT % result_id, 1, nx=True,
+             ex=int(conf['recommend']['inflight_ttl']))
+    cached, acquired = pipe.execute()
+    if acquired and not cached:
+        # the result is written by the recommender itself, see ResultWaiter
+        celery_app.send_task("recommender.recommend",
+                             args=(author_id, record_id, None, user_id),
+                             kwargs={'model_version': model_version},
+                             task_id=result_id)
+    return result_id
+
+
+def _query_precomputed_neighbors(record_id: str) -> Optional[dict]:
+    # anonymous recommendations only depend on the paper and the model, the
+    # recommender precomputes them for every paper with an embedding. They
+    # are the index results as is: the citation graph re-ranking of the
+    # task doesn't apply, and papers without an embedding (not in the
+    # table) fall back to the task and its graph.
+    neighbors = t_neighbors.find_one({'_id': record_id})
+    if neighbors is None \
+            or neighbors['model_version'] != _get_model_version():
+        return None
+    return {'status': 'ok', 'paper_ids': neighbors['paper_ids'],
+            'model_version': neighbors['model_version']}
+
+
+async def _request_recommend(key: str, session: Optional[str]):
+    # returns (result id, None), or (None, result) when it's ready at once
+    user = await run_io(get_user, session, raise_exc=False)
+    # the recommender keeps the profile of the user, no need to ship visits
+    user_id = str(user['_id']) if user else None
     author_id = user['author_id'] if user else None
-    record = _query_record(key)
+    record = await run_io(_query_record, key)
     record_id = str(record['_id'])
-    async_result = celery_app.send_task("recommender.recommend",
-                                        args=(author_id, record_id, visited_ids))
+    if user is None:
+        result = await run_io(_query_precomputed_neighbors, record_id)
+        if result is not None:
+            return None, result
+    return await run_io(_send_recommend_task,
+                        author_id, record_id, user_id), None
+
+
+def _explain_result(result_id: str, result: Optional[dict]):
+    # status is ok (with paper_ids, or results for batches, along with
+    # model_version), failed or pending
+    if result is None:
+        return {'result_id': result_id, 'status': 'pending'}
+    return dict(result, result_id=result_id)
+
+
+def _get_wait_time(wait: float):
+    return min(wait, float(conf['gateway']['max_result_wait']))
+
 
-    celery_app.send_task("recommender.clear_async_result",
-                         args=(async_result.id,),
-                         countdown=60).forget()
+@app.put("/recommend/record/{key:path}")
+async def request_recommend_records(key: str, wait: float = 0,
+                                    session: Optional[str] = Cookie(None)):
+    # with `wait`, the result is returned inline once ready (or the result
+    # id is returned as usual after waiting that many seconds)
+    result_id, result = await _request_recommend(key, session)
+    if result is not None:
+        return _explain_result(result_id, result)
+    if wait <= 0:
+        return {'result_id': result_id}
+    result = await result_waiter.wait(result_id, _get_wait_time(wait))
+    return _explain_result(result_id, result)
+
+
+class RecommendBatchItem(BaseModel):
+    key: str
+    user_id: Optional[str] = None
+
+
+def _resolve_record_ids(keys: List[str]) -> List[Optional[str]]:
+    dois = [key[len('doi:'):] for key in keys if key.startswith('doi:')]
+    doi_to_id = {}
+    if dois:
+        doi_to_id = {record['doi']: record['_id'] for record in
+                     t_records.find(records_by_dois_filter(dois),
+                                    {'_id': 1, 'doi': 1})}
+    return [doi_to_id.get(key[len('doi:'):]) if key.startswith('doi:')
+            else key for key in keys]
+
+
+def check_internal_token(token: Optional[str]):
+    expected = conf['gateway'].get('internal_token', '')
+    if not expected or token is None \
+            or not hmac.compare_digest(token.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail='Internal API')
+
+
+@app.post("/recommend/batch")
+async def request_recommend_batch(
+        items: List[RecommendBatchItem],
+        x_internal_token: Optional[str] = Header(None)):
+    # One recommender.recommend_batch task for many (user, paper) pairs,
+    # its results come back aligned with the items, null for unknown keys.
+    # Internal only: the user ids are trusted as they are.
+    check_internal_token(x_internal_token)
+    record_ids = await run_io(_resolve_record_ids,
+                              [item.key for item in items])
+    async_result = await run_io(
+        celery_app.send_task, "recommender.recommend_batch",
+        args=([[item.user_id, record_id]
+               for item, record_id in zip(items, record_ids)],))
     return {'result_id': async_result.id}
 
 
+@app.get("/recommend/stream/{key:path}")
+async def stream_recommend_records(key: str,
+                                   session: Optional[str] = Cookie(None)):
+    result_id, result = await _request_recommend(key, session)
+
+    async def events():
+        if result is not None:
+            yield 'event: result\ndata: %s\n\n' % json.dumps(
+                _explain_result(result_id, result))
+            return
+        yield 'event: pending\ndata: %s\n\n' % json.dumps(
+            {'result_id': result_id, 'status': 'pending'})
+        waited = await result_waiter.wait(
+            result_id, float(conf['gateway']['max_result_wait']))
+        yield 'event: result\ndata: %s\n\n' % json.dumps(
+            _explain_result(result_id, waited))
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
 @app.get("/recommend/result/{id}")
-async def get_recommend_results(id: str):
-    async_result = AsyncResult(id=id, app=celery_app)
-    if async_result.state == 'SUCCESS':
-        return {'status': 'ok', 'paper_ids': async_result.get()}
-    return {'status': 'pending'}
+async def get_recommend_results(id: str, wait: float = 0):
+    result = _explain_result(id, await result_waiter.wait(
+        id, _get_wait_time(wait)))
+    del result['result_id']
+    return result
 
 
 if __name__ == '__main__':
@@ -0,0 +1,13 @@
+# coding=utf-8
+from prometheus_client import Counter, Histogram
+
+
+__all__ = ['REQUEST_SECONDS', 'CACHE_LOOKUPS']
+
+
+REQUEST_SECONDS = Histogram(
+    'conch_gateway_request_seconds', "Latency of the gateway endpoints",
+    ['method', 'endpoint', 'status'])
+CACHE_LOOKUPS = Counter(
+    'conch_cache_lookups', "Lookups of the gateway caches",
+    ['cache', 'result'])
@@ -0,0 +1,75 @@
+# coding=utf-8
+"""Filters of the gateway's queries on other fields than _id, built here so
+that tests/test_query_plans.py explains the very queries the handlers run
+against the indexes of celery_workers/migrations.py."""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+__all__ = ['SEARCH_RESULT_FIELDS', 'record_filter',
+           'records_by_dois_filter', 'search_filter', 'search_pipeline',
+           'search_count_pipeline', 'user_by_email_filter',
+           'user_by_author_filter', 'login_filter']
+
+
+SEARCH_RESULT_FIELDS = ('_id', 'title', 'authors', 'venue', 'journalName',
+                        'doi', 'fieldsOfStudy')
+
+
+def record_filter(key: str) -> Optional[Dict]:
+    # `doi:...` or a record _id, None for an unknown key pattern
+    if key.startswith('doi:'):
+        return {'doi': key[len('doi:'):]}
+    if len(key) == 40:
+        return {'_id': key}
+    return None
+
+
+def records_by_dois_filter(dois: List[str]) -> Dict:
+    return {'doi': {'$in': dois}}
+
+
+def search_filter(query_str: str) -> Dict:
+    return {'$text': {'$search': query_str}}
+
+
+def search_pipeline(query_str: str, fields: Sequence[str],
+                    after: Optional[Tuple[float, str]],
+                    limit: int) -> List[Dict]:
+    # sorted by (score desc, _id asc), resuming after the (score, _id) of a
+    # cursor; one more result than the limit tells whether there are more
+    pipeline = [
+        {'$match': search_filter(query_str)},
+        {'$project': dict({field: 1 for field in fields},
+                          score={'$meta': 'textScore'})},
+    ]
+    if after is not None:
+        score, record_id = after
+        pipeline.append({'$match': {'$or': [
+            {'score': {'$lt': score}},
+            {'score': score, '_id': {'$gt': record_id}},
+        ]}})
+    pipeline += [
+        {'$sort': {'score': -1, '_id': 1}},
+        {'$limit': limit + 1},
+    ]
+    return pipeline
+
+
+def search_count_pipeline(query_str: str) -> List[Dict]:
+    # what count_documents would run, spelled out so that it's explained
+    return [
+        {'$match': search_filter(query_str)},
+        {'$group': {'_id': None, 'n': {'$sum': 1}}},
+    ]
+
+
+def user_by_email_filter(email: str) -> Dict:
+    return {'email': email}
+
+
+def user_by_author_filter(author_id: int) -> Dict:
+    return {'author_id': author_id}
+
+
+def login_filter(email: str, hashed_password: str) -> Dict:
+    return {'email': email, 'hashed_password': hashed_password}
@@ -0,0 +1,106 @@
+# coding=utf-8
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional
+
+import msgpack
+from redis import Redis
+from redis.exceptions import ConnectionError
+
+from gateways import logger
+from gateways.aio import run_io
+
+
+__all__ = ['result_waiter', 'ResultWaiter', 'decode_result']
+
+
+def _decode_paper_ids(paper_ids):
+    if paper_ids is None:
+        return None
+    return [paper_id.hex() if isinstance(paper_id, bytes) else paper_id
+            for paper_id in paper_ids]
+
+
+def decode_result(payload: bytes) -> Dict:
+    result = msgpack.unpackb(payload, raw=False)
+    if 'paper_ids' in result:
+        result['paper_ids'] = _decode_paper_ids(result['paper_ids'])
+    if 'results' in result:
+        result['results'] = [_decode_paper_ids(paper_ids)
+                             for paper_ids in result['results']]
+    return result
+
+
+class ResultWaiter:
+    # The recommender writes every result under KEY_PREFIX + task id and
+    # publishes it on the channel of the same name, so one pattern
+    # subscription is enough to wake up all the requests waiting in this
+    # process, without polling (keep in sync with
+    # celery_workers/recommender/results.py).
+    KEY_PREFIX = "recommend-result-"
+
+    def __init__(self, r: Optional[Redis] = None):
+        if r is None:
+            from gateways import r as _r
+            r = _r
+        self.r = r
+        self.loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self.waiters = {}  # type: Dict[str, List[asyncio.Future]]
+        self.thread = None  # type: Optional[threading.Thread]
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.thread = threading.Thread(target=self._listen, daemon=True,
+                                       name='result-waiter')
+        self.thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.KEY_PREFIX + '*')
+                for message in pubsub.listen():
+                    channel = message['channel'].decode()
+                    task_id = channel[len(self.KEY_PREFIX):]
+                    if task_id in self.waiters:
+                        self.loop.call_soon_threadsafe(
+                            self._resolve, task_id, message['data'])
+            except ConnectionError:
+                logger.exception("Lost the result subscription, retrying")
+                time.sleep(1)
+
+    def _resolve(self, task_id: str, payload: bytes):
+        result = decode_result(payload)
+        for future in self.waiters.pop(task_id, []):
+            if not future.done():
+                future.set_result(result)
+
+    async def fetch(self, task_id: str) -> Optional[Dict]:
+        payload = await run_io(self.r.get, self.KEY_PREFIX + task_id)
+        return decode_result(payload) if payload is not None else None
+
+    async def wait(self, task_id: str, timeout: float) -> Optional[Dict]:
+        # returns the result, or None if it isn't ready within `timeout`
+        if timeout <= 0:
+            return await self.fetch(task_id)
+
+        future = self.loop.create_future()
+        self.waiters.setdefault(task_id, []).append(future)
+        try:
+            # subscribed before looking, so a result can't slip in between
+            result = await self.fetch(task_id)
+            if result is not None:
+                return result
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            futures = self.waiters.get(task_id, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                self.waiters.pop(task_id, None)
+
+
+result_waiter = ResultWaiter()
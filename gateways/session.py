@@ -31,19 +31,32 @@ class DictProxy(dict):
 class SessionManager:
     KEY_FORMAT = "session-%s"
 
-    def __init__(self, r: Optional[Redis] = None):
+    def __init__(self, r: Optional[Redis] = None, ttl: Optional[int] = None):
         if r is None:
             from gateways import r as _r
             r = _r
+        if ttl is None:
+            from gateways import conf
+            ttl = int(conf['gateway']['cookie_expires'])
         self.r = r
+        self.ttl = ttl
 
     def __getitem__(self, key):
-        return DictProxy(self, key, json.loads(self.r.get(key)))
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key) -> Optional[DictProxy]:
+        value = self.r.get(key)
+        if value is None:
+            return None
+        return DictProxy(self, key, json.loads(value))
 
     def __setitem__(self, key, value):
         if isinstance(value, dict):
             value = json.dumps(value)
-        self.r.set(key, value)
+        self.r.set(key, value, ex=self.ttl)
 
     @staticmethod
     def get_a_random_key():
@@ -0,0 +1,155 @@
+# coding=utf-8
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from redis import Redis
+
+from gateways import conf, logger, t_users
+from gateways.aio import run_io
+from gateways.metrics import CACHE_LOOKUPS
+
+
+__all__ = ['UserSummaryCache', 'user_summary_cache',
+           'VisitHistory', 'visit_history']
+
+
+class UserSummaryCache:
+    # the few user fields the handlers need, so that resolving a session
+    # doesn't load the whole user document
+    KEY_FORMAT = "user-summary-%s"
+    FIELDS = ('author_id', 'email')
+
+    def __init__(self, ttl: int, r: Optional[Redis] = None):
+        if r is None:
+            from gateways import r as _r
+            r = _r
+        self.r = r
+        self.ttl = ttl
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        value = self.r.get(self.KEY_FORMAT % user_id)
+        if value is not None:
+            CACHE_LOOKUPS.labels('user_summary', 'hit').inc()
+            summary = json.loads(value)
+        else:
+            CACHE_LOOKUPS.labels('user_summary', 'miss').inc()
+            summary = t_users.find_one({'_id': ObjectId(user_id)},
+                                       {field: 1 for field in self.FIELDS})
+            if summary is None:
+                return None
+            summary['_id'] = user_id
+            self.r.set(self.KEY_FORMAT % user_id, json.dumps(summary),
+                       ex=self.ttl)
+        summary['_id'] = ObjectId(summary['_id'])
+        return summary
+
+
+class VisitHistory:
+    # The most recent visits of a user in a capped sorted set scored by
+    # time (read by the recommender as well). New visits are queued in
+    # PENDING_KEY and flushed to the user documents in batches.
+    KEY_FORMAT = "visited-%s"
+    LOADED_KEY_FORMAT = "visited-loaded-%s"
+    # bumped by the recommender once a new visit is in the profile (keep
+    # in sync with celery_workers/recommender/profiles.py)
+    REVISION_KEY_FORMAT = "visited-revision-%s"
+    PENDING_KEY = "visited-pending"
+
+    def __init__(self, max_history: int, ttl: int,
+                 r: Optional[Redis] = None):
+        if r is None:
+            from gateways import r as _r
+            r = _r
+        self.r = r
+        self.max_history = max_history
+        self.ttl = ttl
+
+    def _ensure_loaded(self, user_id: str):
+        # the first time, the sorted set is seeded from the user document
+        if not self.r.set(self.LOADED_KEY_FORMAT % user_id, 1,
+                          nx=True, ex=self.ttl):
+            return
+        user = t_users.find_one(
+            {'_id': ObjectId(user_id)},
+            {'visited': {'$slice': -self.max_history}}) or {}
+        visited = user.get('visited') or []
+        if visited:
+            # older than any new visit, in the same order
+            self.r.zadd(self.KEY_FORMAT % user_id,
+                        {record_id: i for i, record_id in enumerate(visited)},
+                        nx=True)
+
+    def add(self, user_id: str, record_id: str) -> bool:
+        # returns whether the record wasn't in the history yet
+        self._ensure_loaded(user_id)
+        key = self.KEY_FORMAT % user_id
+        pipe = self.r.pipeline()
+        pipe.zadd(key, {record_id: time.time()})
+        pipe.zremrangebyrank(key, 0, -self.max_history - 1)
+        pipe.expire(key, self.ttl)
+        pipe.expire(self.LOADED_KEY_FORMAT % user_id, self.ttl)
+        added = pipe.execute()[0]
+        if added:
+            self.r.rpush(self.PENDING_KEY, json.dumps([user_id, record_id]))
+        return bool(added)
+
+    def get_revision(self, user_id: str) -> int:
+        return int(self.r.get(self.REVISION_KEY_FORMAT % user_id) or 0)
+
+    def flush(self, batch_size: int) -> int:
+        # The batch is taken off PENDING_KEY, and pushed back in front of it
+        # (in the same order) for whatever couldn't be written.
+        pipe = self.r.pipeline()
+        pipe.lrange(self.PENDING_KEY, 0, batch_size - 1)
+        pipe.ltrim(self.PENDING_KEY, batch_size, -1)
+        items = pipe.execute()[0]
+        if not items:
+            return 0
+        visits = defaultdict(list)  # type: Dict[str, List[str]]
+        for item in items:
+            user_id, record_id = json.loads(item)
+            visits[user_id].append(record_id)
+        user_ids = list(visits)
+        try:
+            t_users.bulk_write([
+                UpdateOne({'_id': ObjectId(user_id)},
+                          {'$push': {'visited': {
+                              '$each': visits[user_id],
+                              '$slice': -self.max_history}}})
+                for user_id in user_ids
+            ], ordered=False)
+        except BulkWriteError as e:
+            # unordered: the other users are written already
+            failed = {user_ids[error['index']]
+                      for error in e.details['writeErrors']}
+            self._requeue([item for item in items
+                           if json.loads(item)[0] in failed])
+            raise
+        except Exception:
+            self._requeue(items)
+            raise
+        return len(items)
+
+    def _requeue(self, items: List[bytes]):
+        if items:
+            self.r.lpush(self.PENDING_KEY, *reversed(items))
+
+    async def flush_forever(self, interval: float, batch_size: int):
+        while True:
+            try:
+                while await run_io(self.flush, batch_size) >= batch_size:
+                    pass
+            except Exception:
+                logger.exception("Unable to flush the visit history")
+            await asyncio.sleep(interval)
+
+
+user_summary_cache = UserSummaryCache(int(conf['visits']['summary_ttl']))
+visit_history = VisitHistory(int(conf['visits']['max_history']),
+                             int(conf['gateway']['cookie_expires']))
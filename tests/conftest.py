@@ -0,0 +1,8 @@
+# coding=utf-8
+import os
+import sys
+
+# the services read their config files relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
@@ -0,0 +1,39 @@
+# coding=utf-8
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from celery_workers.recommender import conf
+from celery_workers.recommender.artifacts import attach, get_checksums, \
+    sha256sum, verify
+
+
+@pytest.fixture
+def version(monkeypatch, tmp_path):
+    monkeypatch.setitem(conf['artifacts'], 'root', str(tmp_path))
+    os.makedirs(tmp_path / 'v1')
+    (tmp_path / 'v1' / 'word2vec.wv').write_bytes(b'vectors')
+    (tmp_path / 'v1' / 'manifest.json').write_text(json.dumps({
+        'version': 'v1', 'created': 0., 'files': {
+            'word2vec.wv': sha256sum(str(tmp_path / 'v1' / 'word2vec.wv'))}}))
+    return 'v1'
+
+
+def test_concurrent_attach_keeps_every_checksum(tmp_path, version):
+    names = ['derived-%d.npy' % i for i in range(16)]
+    for name in names:
+        (tmp_path / version / name).write_bytes(name.encode())
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda name: attach(version, name), names))
+    assert sorted(get_checksums(version)) == sorted(names + ['word2vec.wv'])
+    verify(version)
+
+
+def test_verify_detects_a_modified_attached_file(tmp_path, version):
+    (tmp_path / version / 'derived.npy').write_bytes(b'table')
+    attach(version, 'derived.npy')
+    (tmp_path / version / 'derived.npy').write_bytes(b'tampered')
+    with pytest.raises(ValueError):
+        verify(version)
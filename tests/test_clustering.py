@@ -0,0 +1,53 @@
+# coding=utf-8
+import numpy as np
+import pytest
+
+from celery_workers.recommender import conf
+from celery_workers.recommender.clustering import ALGORITHMS, \
+    cluster_interest_vectors, compare_with_dbscan, merge_nearest_centers
+
+
+def make_interest_vectors(n_topics: int, per_topic: int, dim: int = 80,
+                          noise: float = 0.02, seed: int = 0) -> np.ndarray:
+    # normalized vectors gathered around a few topics, shuffled in time
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dim))
+    topics /= np.linalg.norm(topics, axis=1, keepdims=True)
+    vectors = np.repeat(topics, per_topic, axis=0) \
+        + rng.normal(scale=noise, size=(n_topics * per_topic, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors[rng.permutation(len(vectors))].astype(np.float32)
+
+
+@pytest.mark.parametrize('algorithm', sorted(ALGORITHMS))
+@pytest.mark.parametrize('n_vectors', [296, 6000])
+def test_bounded_clustering_matches_dbscan(monkeypatch, algorithm,
+                                           n_vectors):
+    # 8 topics of n_vectors // 8; 6000 exceed [clustering] max_samples, so
+    # they are sampled
+    monkeypatch.setitem(conf['clustering'], 'algorithm', algorithm)
+    # the sampling seeded as well, for a reproducible similarity
+    result = compare_with_dbscan(make_interest_vectors(8, n_vectors // 8),
+                                 np.random.default_rng(0))
+    assert result['n_vectors'] == n_vectors
+    assert result['similarity'] >= 0.9
+
+
+@pytest.mark.parametrize('algorithm', sorted(ALGORITHMS))
+def test_centers_are_bounded_by_max_clusters(monkeypatch, algorithm):
+    # scattered interests: DBSCAN finds no cluster and falls back to the
+    # vectors themselves, which are reduced as well
+    monkeypatch.setitem(conf['clustering'], 'algorithm', algorithm)
+    vectors = make_interest_vectors(500, 1, noise=0)
+    centers, counts = cluster_interest_vectors(vectors)
+    assert len(centers) <= int(conf['clustering']['max_clusters'])
+    assert len(centers) == len(counts)
+    assert counts.sum() == len(vectors)
+
+
+def test_merge_nearest_centers():
+    centers = np.array([[0, 0], [10, 0], [0, 1]], dtype=np.float32)
+    counts = np.array([3, 1, 1], dtype=np.int32)
+    centers, counts = merge_nearest_centers(centers, counts)
+    np.testing.assert_allclose(centers, [[0, 0.25], [10, 0]])
+    np.testing.assert_array_equal(counts, [4, 1])
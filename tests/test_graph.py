@@ -0,0 +1,43 @@
+# coding=utf-8
+import gensim
+import numpy as np
+import scipy.sparse
+
+from celery_workers.recommender import tasks
+from celery_workers.recommender.artifacts import Model
+from celery_workers.recommender.graph import CitationGraph
+
+
+def make_graph() -> CitationGraph:
+    # a - b - c - x, x without an embedding
+    wv = gensim.models.KeyedVectors(vector_size=4)
+    wv.add_vectors(['a', 'b', 'c'], np.eye(3, 4, dtype=np.float32))
+    sources, targets = np.array([0, 1, 2]), np.array([1, 2, 3])
+    adjacency = scipy.sparse.csr_matrix(
+        (np.ones(6, dtype=np.int8), (np.concatenate([sources, targets]),
+                                     np.concatenate([targets, sources]))),
+        shape=(4, 4))
+    return CitationGraph(Model('v1', wv, None), adjacency.indptr,
+                         adjacency.indices, np.array([b'x'], dtype=bytes))
+
+
+def test_node_of():
+    graph = make_graph()
+    assert graph.node_of('b') == 1
+    assert graph.node_of('x') == 3
+    assert graph.node_of('y') is None
+    assert graph.node_of(None) is None
+
+
+def test_unresolved_keys_dont_fail_the_batch(monkeypatch):
+    graph = make_graph()
+
+    class Graphs:
+        def get(self, model):
+            return graph
+
+    monkeypatch.setattr(tasks, 'citation_graphs', Graphs())
+    results = tasks.with_citation_graph(
+        None, [(None, None), ('x', None)], [None, None])
+    assert results[0] is None
+    assert results[1][0] == 'c'
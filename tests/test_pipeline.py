@@ -0,0 +1,21 @@
+# coding=utf-8
+import gzip
+import json
+
+from celery_workers.datafeeder.pipeline import read_batches
+
+
+def test_read_batches_keeps_computer_science_lines(tmp_path):
+    path = tmp_path / 's2-corpus-000.gz'
+    fields = ['Computer Science', 'Biology', 'Biology', 'Computer Science',
+              'Medicine']
+    with gzip.open(path, 'wb') as f:
+        for i, field in enumerate(fields):
+            f.write(json.dumps({'id': str(i),
+                                'fieldsOfStudy': [field]}).encode() + b'\n')
+    batches = list(read_batches(path, 2))
+    # the offsets count every line of the file
+    assert [(start, end) for start, end, _ in batches] \
+        == [(0, 2), (2, 4), (4, 5)]
+    assert [[json.loads(line)['id'] for line in lines]
+            for _, _, lines in batches] == [['0'], ['3'], []]
@@ -0,0 +1,137 @@
+# coding=utf-8
+"""Every query on other fields than _id (which is always indexed) must be
+served by an index of celery_workers/migrations.py. The filters come from
+the modules issuing them, and are explained against a scratch database of
+the Mongo at $CONCH_TEST_MONGO_URL; skipped when it isn't set."""
+import datetime
+import importlib
+import os
+from typing import Dict, Iterator
+
+import pymongo
+import pytest
+
+from celery_workers import migrations
+from celery_workers.recommender import corpus
+
+
+def import_gateway_module(name: str):
+    # the gateway reads its config.ini from its own directory
+    cwd = os.getcwd()
+    os.chdir('gateways')
+    try:
+        return importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+
+
+queries = import_gateway_module('gateways.queries')
+
+NOW = datetime.datetime(2021, 1, 1)
+
+
+def make_records(n: int):
+    for i in range(n):
+        yield {
+            '_id': '%040x' % i,
+            'doi': '10.%04d/%d' % (i % 100, i),
+            'title': 'learning %d about topic %d' % (i, i % 7),
+            'fieldsOfStudy': ['Computer Science'],
+            'outCitations': ['%040x' % ((i + j) % n) for j in range(1, 5)],
+            'inCitations': [],
+            'ingestedAt': NOW - datetime.timedelta(minutes=n - i),
+        }
+
+
+def make_users(n: int):
+    for i in range(n):
+        yield {'email': 'user%d@example.com' % i,
+               'hashed_password': '%032x' % i,
+               'author_id': i,
+               'visited': []}
+
+
+@pytest.fixture(scope='module')
+def db():
+    url = os.environ.get('CONCH_TEST_MONGO_URL')
+    if not url:
+        pytest.skip("CONCH_TEST_MONGO_URL is not set")
+    client = pymongo.MongoClient(url, serverSelectionTimeoutMS=2000)
+    name = 'conch-test-query-plans'
+    client.drop_database(name)
+    db = client[name]
+    # enough documents that a scan is never free
+    db['records'].insert_many(make_records(2000))
+    db['users'].insert_many(make_users(500))
+    migrations.create_indexes(db)
+    yield db
+    client.drop_database(name)
+    client.close()
+
+
+def find(collection: str, filter: Dict, sort=None, limit: int = 0) -> Dict:
+    command = {'find': collection, 'filter': filter}
+    if sort:
+        command['sort'] = dict(sort)
+    if limit:
+        command['limit'] = limit
+    return command
+
+
+COMMANDS = {
+    # gateways/main.py
+    'gateway.record_by_doi':
+        find('records', queries.record_filter('doi:10.0001/1')),
+    'gateway.records_by_dois':
+        find('records', queries.records_by_dois_filter(
+            ['10.0001/1', '10.0002/2'])),
+    'gateway.search_records': {
+        'aggregate': 'records',
+        'pipeline': queries.search_pipeline(
+            'learning', queries.SEARCH_RESULT_FIELDS, (1.0, '%040x' % 1),
+            20),
+        'cursor': {}},
+    'gateway.count_search_records': {
+        'aggregate': 'records',
+        'pipeline': queries.search_count_pipeline('learning'),
+        'cursor': {}},
+    'gateway.user_by_email':
+        find('users', queries.user_by_email_filter('user1@example.com')),
+    'gateway.user_by_author_id':
+        find('users', queries.user_by_author_filter(1)),
+    'gateway.login':
+        find('users', queries.login_filter('user1@example.com', '%032x' % 1)),
+    # celery_workers/recommender/corpus.py
+    'recommender.last_ingested':
+        find('records', {}, sort=corpus.LAST_INGESTED_SORT, limit=1),
+    'recommender.incremental_corpus':
+        find('records', corpus.corpus_filter(corpus.ingested_since(
+            NOW - datetime.timedelta(minutes=10)))),
+}
+# reading whole collections on purpose, not checked:
+# datafeeder.build_title_autocomplete, recommender.export_corpus (full),
+# recommender.build_citation_graph, recommender.evaluate_clustering
+
+
+def find_stages(plan) -> Iterator[str]:
+    # every stage of the winning plans, whatever the nesting (find,
+    # aggregate and sharded explain outputs differ)
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'rejectedPlans':
+                continue
+            if key == 'stage' and isinstance(value, str):
+                yield value
+            else:
+                yield from find_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from find_stages(value)
+
+
+@pytest.mark.parametrize('name', sorted(COMMANDS))
+def test_query_uses_an_index(db, name):
+    plan = db.command('explain', COMMANDS[name], verbosity='queryPlanner')
+    stages = list(find_stages(plan))
+    assert stages
+    assert 'COLLSCAN' not in stages, ' > '.join(stages)